@@ -1,15 +1,41 @@
 import os.path
 import base64
 import email
+import email.policy
 import datetime
-import argparse
 import logging
+import json
+import queue
+import sqlite3
+import threading
+import zlib
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import google_auth_httplib2
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+
+try:
+    # SIMD-accelerated decoder, noticeably faster on large message bodies
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # Configure logging
@@ -24,9 +50,60 @@ SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
 TOKEN_FILE_PATH = "gmailfetch/token.json"
 CREDENTIALS_FILE_PATH = "gmailfetch/credentials.json"
+# Local copy of fetched emails plus the Gmail historyId they are current as of
+CACHE_DB_PATH = "gmailfetch/email_cache.db"
+# Bumped whenever the cache tables change; older cache files are rebuilt
+CACHE_SCHEMA_VERSION = 4
+
+# Maximum number of calls Gmail accepts in a single batch request
+GMAIL_BATCH_SIZE = 100
+# Largest page Gmail returns from messages().list()
+GMAIL_LIST_PAGE_SIZE = 500
+# Concurrent get() calls used when the batch endpoint is unavailable,
+# kept low to stay under Gmail's per-user quota
+GMAIL_FETCH_WORKERS = 10
+
+# Headers requested when only the message metadata is needed
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date']
+# MIME type of the part used as the email body
+TEXT_PLAIN_MIME_TYPE = 'text/plain'
+# Header names as Gmail usually spells them, mapped to the keys used in email data
+_HEADER_KEYS = {name: name.lower() for name in METADATA_HEADERS}
+_HEADER_KEYS.update({key: key for key in _HEADER_KEYS.values()})
+
+# httplib2.Http is not thread-safe, so each worker thread gets its own
+_thread_local = threading.local()
+
+# Authorized Gmail service shared across calls so its HTTP connection is reused,
+# keyed on the token file's mtime so a replaced token.json is picked up
+_cred_cache = {'mtime': None, 'creds': None, 'service': None}
+
+class FastJsonModel(JsonModel):
+    """JsonModel that parses API responses with orjson when it is installed."""
+    
+    def deserialize(self, content):
+        if orjson is None:
+            return super().deserialize(content)
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
 
 def get_gmail_service():
-    """Authenticate and return the Gmail service."""
+    """Authenticate and return the Gmail service.
+    
+    The service is reused until token.json changes on disk; its credentials
+    refresh themselves when the access token expires.
+    """
+    mtime = _token_mtime()
+    cached_creds = _cred_cache['creds']
+    if (_cred_cache['service'] is not None and _cred_cache['mtime'] == mtime
+            and (cached_creds.valid or cached_creds.refresh_token)):
+        return _cred_cache['service']
+    
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -38,6 +115,8 @@ def get_gmail_service():
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
+            # Only needed for the interactive login, and slow to import
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 CREDENTIALS_FILE_PATH, SCOPES
             )
@@ -47,137 +126,497 @@ def get_gmail_service():
             token.write(creds.to_json())
     
     # Build and return the Gmail service
-    service = build("gmail", "v1", credentials=creds)
+    service = build("gmail", "v1", credentials=creds, model=FastJsonModel())
+    _cred_cache.update(mtime=_token_mtime(), creds=creds, service=service)
     return service
 
-def get_email_content(service, msg_id):
-    """Get the full content of an email message."""
+def _token_mtime():
+    """Return the token file's modification time, or None if it does not exist."""
     try:
+        return os.path.getmtime(TOKEN_FILE_PATH)
+    except OSError:
+        return None
+
+def _message_get_request(service, msg_id, need_body=True):
+    """Build the messages().get() request, asking only for headers when no body is needed."""
+    if need_body:
+        return service.users().messages().get(userId='me', id=msg_id, format='full')
+    return service.users().messages().get(
+        userId='me', id=msg_id, format='metadata',
+        metadataHeaders=METADATA_HEADERS, fields='id,snippet,payload/headers'
+    )
+
+def get_email_content(service, msg_id, raw=False):
+    """Get the full content of an email message.
+    
+    With raw=True the RFC822 source is fetched as a single base64 blob and
+    parsed locally instead of walking the JSON MIME tree.
+    """
+    try:
+        if raw:
+            message = service.users().messages().get(userId='me', id=msg_id, format='raw').execute()
+            return _parse_raw_message(message, msg_id)
         # Get the full message
-        message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-        
-        # Get message payload and headers
-        payload = message.get('payload', {})
-        headers = payload.get('headers', [])
-        
-        # Extract header information
-        email_data = {
-            'id': msg_id,
-            'subject': next((header['value'] for header in headers if header['name'].lower() == 'subject'), 'No Subject'),
-            'from': next((header['value'] for header in headers if header['name'].lower() == 'from'), 'Unknown Sender'),
-            'to': next((header['value'] for header in headers if header['name'].lower() == 'to'), 'Unknown Recipient'),
-            'date': next((header['value'] for header in headers if header['name'].lower() == 'date'), 'Unknown Date'),
-        }
-        
-        # Get the message body
-        body = ""
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    body = get_message_text(part)
-                    break
-                elif 'parts' in part:  # Handle nested parts
-                    for subpart in part['parts']:
-                        if subpart['mimeType'] == 'text/plain':
-                            body = get_message_text(subpart)
-                            break
-        elif 'body' in payload and 'data' in payload['body']:
-            body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
-        
-        email_data['body'] = body
-        email_data['snippet'] = message.get('snippet', 'No preview available')
-        
-        return email_data
+        message = _message_get_request(service, msg_id).execute()
+        return _parse_message(message, msg_id)
+    except Exception as e:
+        logger.error(f"Error retrieving email content: {e}")
+        return None
+
+def get_email_headers(service, msg_id):
+    """Get the headers and snippet of an email message without its body."""
+    try:
+        message = _message_get_request(service, msg_id, need_body=False).execute()
+        return _parse_message(message, msg_id)
     except Exception as e:
-        logger.info(f"Error retrieving email content: {e}")
+        logger.error(f"Error retrieving email headers: {e}")
+        return None
+
+def _parse_message(message, msg_id):
+    """Build the email data dict from a Gmail API message resource.
+    
+    Returns None if the resource is missing its payload or headers.
+    """
+    # Get message payload and headers
+    try:
+        payload = message['payload']
+        headers = payload['headers']
+    except KeyError:
+        logger.error(f"Malformed message resource for {msg_id}")
         return None
+    
+    # Extract header information, keeping the first occurrence of each header
+    header_map = {}
+    for header in headers:
+        key = _HEADER_KEYS.get(header['name'])
+        if key is not None:
+            header_map.setdefault(key, header['value'])
+    # Only lowercase every name when a header used unusual capitalization
+    if len(header_map) < len(METADATA_HEADERS):
+        for header in headers:
+            header_map.setdefault(header['name'].lower(), header['value'])
+    email_data = {
+        'id': msg_id,
+        'subject': header_map.get('subject', 'No Subject'),
+        'from': header_map.get('from', 'Unknown Sender'),
+        'to': header_map.get('to', 'Unknown Recipient'),
+        'date': header_map.get('date', 'Unknown Date'),
+    }
+    
+    # Get the message body
+    body = ""
+    if 'parts' in payload:
+        text_part = _find_text_plain(payload)
+        if text_part is not None:
+            body = get_message_text(text_part)
+    elif (payload_body := payload.get('body')) and (data := payload_body.get('data')):
+        body = _b64url_decode(data).decode('utf-8', errors='replace')
+    
+    email_data['body'] = body
+    email_data['snippet'] = message.get('snippet', 'No preview available')
+    # Receive time in epoch ms, orders the cached emails
+    email_data['internal_date'] = int(message.get('internalDate', 0))
+    
+    return email_data
+
+def _parse_raw_message(message, msg_id):
+    """Build the email data dict from a Gmail API message fetched with format='raw'."""
+    msg = email.message_from_bytes(_b64url_decode(message['raw']), policy=email.policy.default)
+    
+    body = ""
+    body_part = msg.get_body(preferencelist=('plain', 'html'))
+    if body_part is not None:
+        body = body_part.get_content()
+    
+    return {
+        'id': msg_id,
+        'subject': msg.get('Subject', 'No Subject'),
+        'from': msg.get('From', 'Unknown Sender'),
+        'to': msg.get('To', 'Unknown Recipient'),
+        'date': msg.get('Date', 'Unknown Date'),
+        'body': body,
+        'snippet': message.get('snippet', 'No preview available'),
+        'internal_date': int(message.get('internalDate', 0)),
+    }
+
+def _find_text_plain(payload):
+    """Return the first text/plain part with body data, searching nested parts in order."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('mimeType') == TEXT_PLAIN_MIME_TYPE and 'data' in part.get('body', {}):
+            return part
+        # Push children reversed so they are visited in document order
+        stack.extend(reversed(part.get('parts', ())))
+    return None
+
+def _b64url_decode(data):
+    """Decode Gmail's URL-safe base64 body data."""
+    return _b64.b64decode(data, altchars=b'-_', validate=False)
 
 def get_message_text(message_part):
     """Decode and return the message text from a message part."""
-    if 'body' in message_part and 'data' in message_part['body']:
-        text = base64.urlsafe_b64decode(message_part['body']['data']).decode('utf-8', errors='replace')
-        return text
+    if (part_body := message_part.get('body')) and (data := part_body.get('data')):
+        return _b64url_decode(data).decode('utf-8', errors='replace')
     return ""
 
 def list_labels(service):
     """List all available Gmail labels."""
-    results = service.users().labels().list(userId="me").execute()
+    results = service.users().labels().list(userId="me", fields="labels(id,name)").execute()
     labels = results.get("labels", [])
     
     if not labels:
         logger.info("No labels found.")
         return []
     
-    logger.info("Available labels:")
-    for label in labels:
-        logger.info(f"- {label['name']}")
+    logger.info("Available labels:\n" + "\n".join(f"- {label['name']}" for label in labels))
     
     return labels
 
-def fetch_emails(service, label_ids=['INBOX'], max_results=10, query=None):
-    """Fetch emails from specified labels with optional query."""
+def fetch_emails(service, label_ids=['INBOX'], max_results=10, query=None, need_body=False, list_state=None):
+    """Fetch emails from specified labels with optional query.
+    
+    Only headers and snippet are requested unless need_body is True. Message
+    IDs are paged in on a background thread while earlier ones are fetched.
+    If list_state is a dict, list_state['listed'] is set to the number of IDs
+    listed and list_state['exhausted'] to True when the listing ran out of
+    messages before reaching max_results.
+    """
     try:
         # Build the list request
         request = {
             'userId': 'me',
             'labelIds': label_ids,
-            'maxResults': max_results
+            # threadId and resultSizeEstimate are never used
+            'fields': 'messages/id,nextPageToken'
         }
         if query:
             request['q'] = query
-            
-        # Execute the request
-        results = service.users().messages().list(**request).execute()
-        messages = results.get('messages', [])
         
-        if not messages:
-            logger.info(f"No messages found with the specified criteria.")
-            return []
+        id_queue = queue.Queue(maxsize=GMAIL_BATCH_SIZE * 2)
+        list_errors = []
+        producer = threading.Thread(
+            target=_produce_message_ids,
+            args=(service, request, max_results, id_queue, list_errors, list_state),
+            daemon=True
+        )
+        producer.start()
         
-        logger.info(f"\nFound {len(messages)} messages.")
         email_list = []
+        found = 0
+        finished = False
+        while not finished:
+            msg_id = id_queue.get()
+            if msg_id is None:
+                break
+            # Drain whatever else is already queued, up to one batch
+            msg_ids = [msg_id]
+            while len(msg_ids) < GMAIL_BATCH_SIZE:
+                try:
+                    msg_id = id_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if msg_id is None:
+                    finished = True
+                    break
+                msg_ids.append(msg_id)
+            found += len(msg_ids)
+            email_list.extend(_fetch_message_chunk(service, msg_ids, need_body))
         
-        for i, message in enumerate(messages, 1):
-            email_data = get_email_content(service, message['id'])
-            if email_data:
-                email_list.append(email_data)
-            
-            # Print progress for larger fetches
-            if i % 5 == 0 and max_results > 5:
-                logger.info(f"Processed {i}/{min(len(messages), max_results)} emails...")
+        producer.join()
+        if list_errors:
+            raise list_errors[0]
         
+        if not found:
+            logger.info(f"No messages found with the specified criteria.")
+            return []
+        
+        logger.info(f"\nFound {found} messages.")
         return email_list
         
     except HttpError as error:
-        logger.info(f"An error occurred: {error}")
+        logger.error(f"An error occurred: {error}")
         return []
 
+def _produce_message_ids(service, request, max_results, id_queue, errors, state=None):
+    """Page through messages().list() and queue up to max_results IDs, then None."""
+    http = _get_thread_http(service)
+    remaining = max_results
+    page_token = None
+    try:
+        while remaining > 0:
+            page_request = dict(request, maxResults=min(remaining, GMAIL_LIST_PAGE_SIZE))
+            if page_token:
+                page_request['pageToken'] = page_token
+            results = service.users().messages().list(**page_request).execute(http=http)
+            messages = results.get('messages', [])
+            for message in messages[:remaining]:
+                id_queue.put(message['id'])
+            remaining -= len(messages)
+            if state is not None:
+                state['listed'] = max_results - max(remaining, 0)
+            page_token = results.get('nextPageToken')
+            if not messages or not page_token:
+                if state is not None:
+                    state['exhausted'] = remaining > 0
+                break
+    except Exception as e:
+        errors.append(e)
+    finally:
+        id_queue.put(None)
+
+def _fetch_message_chunk(service, msg_ids, need_body):
+    """Fetch a chunk of messages in one batch, falling back to concurrent gets."""
+    try:
+        return fetch_messages_batch(service, msg_ids, need_body=need_body)
+    except Exception as e:
+        logger.warning(f"Batch request failed ({e}), falling back to concurrent fetches")
+        return fetch_messages_threaded(service, msg_ids, need_body=need_body)
+
+def fetch_messages_batch(service, msg_ids, need_body=True):
+    """Fetch messages with Gmail batch requests, preserving the order of msg_ids."""
+    results = {}
+    
+    def _on_msg(request_id, response, exception):
+        if exception is not None:
+            logger.error(f"Error retrieving email content: {exception}")
+            return
+        index = int(request_id)
+        results[index] = _parse_message(response, msg_ids[index])
+    
+    # Gmail accepts at most GMAIL_BATCH_SIZE calls per batch request
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_on_msg)
+        for i, msg_id in enumerate(msg_ids[start:start + GMAIL_BATCH_SIZE], start):
+            batch.add(_message_get_request(service, msg_id, need_body), request_id=str(i))
+        batch.execute()
+        
+        # Print progress for larger fetches
+        if len(msg_ids) > GMAIL_BATCH_SIZE and logger.isEnabledFor(logging.INFO):
+            logger.info(f"Processed {min(start + GMAIL_BATCH_SIZE, len(msg_ids))}/{len(msg_ids)} emails...")
+    
+    return [results[i] for i in sorted(results) if results[i]]
+
+def _get_thread_http(service):
+    """Return an authorized HTTP transport owned by the calling thread."""
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        credentials = service._http.credentials
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        _thread_local.http = http
+    return http
+
+def fetch_messages_threaded(service, msg_ids, need_body=True, max_workers=GMAIL_FETCH_WORKERS):
+    """Fetch messages with concurrent get() calls, preserving the order of msg_ids."""
+    def _fetch(msg_id):
+        try:
+            message = _message_get_request(service, msg_id, need_body).execute(
+                http=_get_thread_http(service)
+            )
+            return _parse_message(message, msg_id)
+        except Exception as e:
+            logger.error(f"Error retrieving email content: {e}")
+            return None
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [email_data for email_data in executor.map(_fetch, msg_ids) if email_data]
+
+def _open_cache():
+    """Open the email cache database, creating its tables on first use."""
+    conn = sqlite3.connect(CACHE_DB_PATH)
+    if conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+        conn.execute("DROP TABLE IF EXISTS messages")
+        conn.execute("DROP TABLE IF EXISTS sync_state")
+        conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+    # Bodies are stored compressed; codec records how ('zstd' or 'zlib').
+    # Rows are ordered by Gmail's internalDate, so a re-added old message keeps its place
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL, label TEXT NOT NULL, data TEXT NOT NULL, "
+        "body BLOB NOT NULL, codec TEXT NOT NULL, internal_date INTEGER NOT NULL, UNIQUE (id, label))"
+    )
+    # complete: the cache holds every message of the label, so fewer than max_results is not a gap
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sync_state ("
+        "label TEXT PRIMARY KEY, history_id TEXT NOT NULL, complete INTEGER NOT NULL DEFAULT 0)"
+    )
+    return conn
+
+# Body codecs this environment can read; zstandard is optional
+READABLE_CODECS = ('zstd', 'zlib') if zstandard is not None else ('zlib',)
+
+def _compress_body(body):
+    """Compress an email body for the cache, returning (blob, codec)."""
+    raw = body.encode('utf-8')
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(raw), 'zstd'
+    return zlib.compress(raw), 'zlib'
+
+def _decompress_body(blob, codec):
+    """Inverse of _compress_body."""
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(blob).decode('utf-8')
+    return zlib.decompress(blob).decode('utf-8')
+
+def _store_emails(conn, label_id, emails):
+    """Insert emails into the cache."""
+    rows = []
+    for email_data in emails:
+        headers = {key: value for key, value in email_data.items() if key != 'body'}
+        body, codec = _compress_body(email_data['body'])
+        rows.append((email_data['id'], label_id, json.dumps(headers), body, codec, email_data.get('internal_date', 0)))
+    conn.executemany(
+        "INSERT OR REPLACE INTO messages (id, label, data, body, codec, internal_date) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+
+def _load_email(data, body, codec):
+    """Rebuild an email data dict from a cache row."""
+    email_data = json.loads(data)
+    email_data['body'] = _decompress_body(body, codec)
+    return email_data
+
+def _list_history_changes(service, label_id, start_history_id):
+    """Return (added_ids, removed_ids, latest_history_id) for a label since start_history_id."""
+    added, removed = [], set()
+    history_id = start_history_id
+    page_token = None
+    while True:
+        request = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'labelId': label_id,
+            'historyTypes': ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+        }
+        if page_token:
+            request['pageToken'] = page_token
+        results = service.users().history().list(**request).execute()
+        for record in results.get('history', []):
+            for change in record.get('messagesAdded', []) + record.get('labelsAdded', []):
+                message = change['message']
+                if label_id in message.get('labelIds', []):
+                    added.append(message['id'])
+                    removed.discard(message['id'])
+            for change in record.get('messagesDeleted', []):
+                removed.add(change['message']['id'])
+            for change in record.get('labelsRemoved', []):
+                if label_id in change.get('labelIds', []):
+                    removed.add(change['message']['id'])
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    # A message added then removed within the window is simply gone
+    added = [msg_id for msg_id in dict.fromkeys(added) if msg_id not in removed]
+    return added, removed, history_id
+
+def fetch_emails_cached(service, label_id='INBOX', max_results=10):
+    """Fetch the most recent emails of a label, pulling only changes since the last call.
+    
+    The first call (or one after the stored historyId expires) does a full
+    fetch; later calls ask history().list() which messages were added or
+    removed and only fetch the new ones. When removals leave fewer than
+    max_results cached, the label is fetched in full again to backfill, unless
+    the last full fetch already reached the end of the label.
+    """
+    with closing(_open_cache()) as conn:
+        row = conn.execute("SELECT history_id, complete FROM sync_state WHERE label = ?", (label_id,)).fetchone()
+        complete = bool(row and row[1])
+        cached_count = conn.execute("SELECT COUNT(*) FROM messages WHERE label = ?", (label_id,)).fetchone()[0]
+        # Rows written with a codec that is not installed here (zstd without zstandard) are a miss
+        unreadable = conn.execute(
+            f"SELECT COUNT(*) FROM messages WHERE label = ? AND codec NOT IN ({','.join('?' * len(READABLE_CODECS))})",
+            (label_id, *READABLE_CODECS)
+        ).fetchone()[0]
+        
+        changes = None
+        if row and (cached_count >= max_results or complete) and not unreadable:
+            try:
+                changes = _list_history_changes(service, label_id, row[0])
+            except HttpError as error:
+                # Gmail only keeps history for a limited time; resync when it is gone
+                if error.resp.status != 404:
+                    raise
+                logger.info(f"History {row[0]} expired, resyncing {label_id}")
+        
+        if changes is not None:
+            added, removed, history_id = changes
+            if removed:
+                conn.executemany(
+                    "DELETE FROM messages WHERE id = ? AND label = ?",
+                    [(msg_id, label_id) for msg_id in removed]
+                )
+            if added:
+                logger.info(f"Fetching {len(added)} new messages for {label_id}")
+                _store_emails(conn, label_id, _fetch_message_chunk(service, added, need_body=True))
+            # Removed emails are not backfilled by history; resync when too few are left,
+            # unless the label has no older messages to backfill from
+            if (not complete and
+                    conn.execute("SELECT COUNT(*) FROM messages WHERE label = ?", (label_id,)).fetchone()[0] < max_results):
+                logger.info(f"Fewer than {max_results} cached emails left for {label_id}, resyncing")
+                changes = None
+        
+        if changes is None:
+            history_id = service.users().getProfile(userId='me').execute()['historyId']
+            list_state = {}
+            emails = fetch_emails(service, label_ids=[label_id], max_results=max_results, need_body=True,
+                                  list_state=list_state)
+            conn.execute("DELETE FROM messages WHERE label = ?", (label_id,))
+            _store_emails(conn, label_id, reversed(emails))
+            # Messages that failed to download would leave gaps, so only a clean listing counts
+            complete = list_state.get('exhausted', False) and len(emails) == list_state.get('listed')
+        
+        # Keep only as many emails as callers ask for; larger requests resync
+        trimmed = conn.execute(
+            "DELETE FROM messages WHERE label = ? AND seq NOT IN "
+            "(SELECT seq FROM messages WHERE label = ? ORDER BY internal_date DESC, seq DESC LIMIT ?)",
+            (label_id, label_id, max_results)
+        ).rowcount
+        if trimmed:
+            complete = False
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (label, history_id, complete) VALUES (?, ?, ?)",
+            (label_id, str(history_id), int(complete))
+        )
+        conn.commit()
+        
+        rows = conn.execute(
+            "SELECT data, body, codec FROM messages WHERE label = ? ORDER BY internal_date DESC, seq DESC",
+            (label_id,)
+        ).fetchall()
+    return [_load_email(*row) for row in rows]
+
 def display_email(email_data, show_body=True):
     """Display email information in a readable format."""
-    logger.info("\n" + "=" * 80)
-    logger.info(f"ID: {email_data['id']}")
-    logger.info(f"From: {email_data['from']}")
-    logger.info(f"To: {email_data['to']}")
-    logger.info(f"Date: {email_data['date']}")
-    logger.info(f"Subject: {email_data['subject']}")
-    logger.info("-" * 80)
+    lines = [
+        "",
+        "=" * 80,
+        f"ID: {email_data['id']}",
+        f"From: {email_data['from']}",
+        f"To: {email_data['to']}",
+        f"Date: {email_data['date']}",
+        f"Subject: {email_data['subject']}",
+        "-" * 80,
+    ]
     
     if show_body:
-        logger.info("Body:")
-        logger.info(email_data['body'] if email_data['body'] else email_data['snippet'])
+        lines.append("Body:")
+        lines.append(email_data['body'] if email_data['body'] else email_data['snippet'])
     else:
-        logger.info("Preview:")
-        logger.info(email_data['snippet'])
+        lines.append("Preview:")
+        lines.append(email_data['snippet'])
     
-    logger.info("=" * 80)
+    lines.append("=" * 80)
+    logger.info("\n".join(lines))
 
-def get_complete_emails(count=5, display=False):
+def get_complete_emails(count=5, display=False, use_cache=True):
     """
     Fetch complete emails from INBOX.
     
     Args:
         count: Number of emails to fetch (default: 5)
         display: Whether to display the emails after fetching (default: False)
+        use_cache: Only pull changes since the last call via the local cache (default: True)
         
     Returns:
         List of email objects with complete content
@@ -189,12 +628,16 @@ def get_complete_emails(count=5, display=False):
         logger.info(f"Fetching {count} complete emails from INBOX...")
         
         # Fetch emails from INBOX
-        emails = fetch_emails(
-            service,
-            label_ids=['INBOX'],
-            max_results=count,
-            query=None
-        )
+        if use_cache:
+            emails = fetch_emails_cached(service, label_id='INBOX', max_results=count)
+        else:
+            emails = fetch_emails(
+                service,
+                label_ids=['INBOX'],
+                max_results=count,
+                query=None,
+                need_body=True
+            )
         
         # Display emails if requested
         if display and emails:
@@ -204,15 +647,17 @@ def get_complete_emails(count=5, display=False):
         return emails
     
     except HttpError as error:
-        logger.info(f"An error occurred: {error}")
+        logger.error(f"An error occurred: {error}")
         return []
     except Exception as e:
-        logger.info(f"An unexpected error occurred: {e}")
+        logger.error(f"An unexpected error occurred: {e}")
         return []
 
 
 def main():
     """Enhanced Gmail API tool to interact with your email inbox."""
+    import argparse
+    
     parser = argparse.ArgumentParser(description='Gmail API Email Retrieval Tool')
     parser.add_argument('--list-labels', action='store_true', help='List all available Gmail labels')
     parser.add_argument('--label', default='INBOX', help='Label to fetch emails from (default: INBOX)')
@@ -222,6 +667,7 @@ def main():
     parser.add_argument('--id', help='Fetch and display a specific email by ID')
     parser.add_argument('--complete', action='store_true', help='Fetch complete emails from INBOX (default: 5 emails)')
     parser.add_argument('--count', type=int, default=5, help='Number of complete emails to fetch (works with --complete)')
+    parser.add_argument('--no-cache', action='store_true', help='Refetch every email instead of only changes since the last --complete run')
     
     args = parser.parse_args()
     
@@ -246,7 +692,7 @@ def main():
         
         # Handle the complete emails request
         if args.complete:
-            emails = get_complete_emails(count=args.count, display=True)
+            emails = get_complete_emails(count=args.count, display=True, use_cache=not args.no_cache)
             return
         
         # Otherwise fetch emails based on criteria
@@ -258,7 +704,8 @@ def main():
             service,
             label_ids=label_ids,
             max_results=args.max,
-            query=args.query
+            query=args.query,
+            need_body=args.full
         )
         
         # Display the retrieved emails
@@ -266,9 +713,9 @@ def main():
             display_email(email_data, show_body=args.full)
             
     except HttpError as error:
-        logger.info(f"An error occurred: {error}")
+        logger.error(f"An error occurred: {error}")
     except Exception as e:
-        logger.info(f"An unexpected error occurred: {e}")
+        logger.error(f"An unexpected error occurred: {e}")
 
 if __name__ == "__main__":
   main()
@@ -5,52 +5,181 @@ SPDX-License-Identifier: MIT-0
 import os
 import re
 import json
+import copy
+import orjson
 import time
-import html
+import base64
+import quopri
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gradio as gr
-import base64
 import uuid
+import hashlib
+import math
+import functools
+from types import MappingProxyType
 import imaplib
 import email
 import email.header
+import email.message
 import email.utils
+from email.parser import BytesParser
 import asyncio
 import threading
 from datetime import datetime
-from io import BytesIO
-import copy
-from email_validator import validate_email, EmailNotValidError
+from itertools import chain
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import Future
+from email_validator import validate_email, EmailNotValidError, SPECIAL_USE_DOMAIN_NAMES
+try:
+    # SIMD-accelerated decoder, noticeably faster on large message bodies
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
 from dotenv import load_dotenv
-# Import Gmail fetch functionality
-from gmailfetch.gmailfetch import get_gmail_service, get_complete_emails
+# Gmail API客户端、聊天客户端(boto3/openai)和报价服务器(mcp)导入较慢, 在第一次使用时才导入, 加快界面启动
 load_dotenv()  # load env vars from .env
 API_KEY = os.environ.get("API_KEY")
 
-# Import the process_query_stream function
-from src.compatible_chat_client_stream import CompatibleChatClientStream
-
 # Set up detailed logging
 logging.basicConfig(
     level=logging.DEBUG,  # Changed to DEBUG for more detailed logs
 )
 
 mcp_base_url = os.environ.get('MCP_BASE_URL')
+# 后端各接口的完整URL, 在导入时拼接一次
+_BASE_URL = (mcp_base_url or '').rstrip('/')
+URL_LIST_MODELS = _BASE_URL + '/v1/list/models'
+URL_LIST_MCP_SERVERS = _BASE_URL + '/v1/list/mcp_server'
+URL_ADD_MCP_SERVER = _BASE_URL + '/v1/add/mcp_server'
+URL_CHAT = _BASE_URL + '/v1/chat/completions'
 mcp_command_list = ["uvx", "npx", "node", "python", "docker", "uv"]
+# 校验用: 集合成员判断为O(1), mcp_command_list仍用于下拉框的choices
+_MCP_CMDS = frozenset(mcp_command_list)
+_SERVER_ID_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9_]*$')
 COOKIE_NAME = "mcp_chat_user_id"
 EMAIL_ACCOUNTS_PATH = "conf/email_accounts.json"
+# 已解析的邮箱账户配置, 按文件的修改时间判断是否需要重新读取
+_accounts_cache = {"mtime": None, "data": None}
+# 复用已登录的IMAP连接, 按(服务器, 端口, 用户名)区分; 空闲连接定期发送NOOP防止被服务器断开.
+# 每5分钟检查一次, 空闲满20分钟的连接发送NOOP, 赶在服务器30分钟的空闲超时之前
+IMAP_KEEPALIVE_INTERVAL = 5 * 60
+IMAP_KEEPALIVE_IDLE = 20 * 60
+# IMAP套接字的超时(秒), 服务器无响应时不会一直占用连接锁
+IMAP_TIMEOUT = 30
+_imap_pool = {}
+_imap_pool_lock = threading.Lock()
+_imap_keepalive_timer = None
+# 从FETCH响应中取出UID
+_UID_RE = re.compile(rb"\bUID (\d+)")
+# 列表只需要邮件头, 复用同一个解析器并跳过MIME正文
+_HEADER_PARSER = BytesParser()
+_IMAP_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+# MCP服务器信息, 比嵌套dict更省内存
+ServerInfo = namedtuple('ServerInfo', ['server_id', 'server_desc'])
+
+# 流式输出时每攒够这么多片段或超过这个间隔(秒)才刷新一次UI
+STREAM_YIELD_CHUNKS = 16
+STREAM_YIELD_INTERVAL = 0.05
+# 每次请求最多携带的历史对话轮数
+MAX_HISTORY_TURNS = 32
+
+# 预编译非流式响应中thinking标签的正则
+_THINK_RE = re.compile(r"<thinking>(.*?)</thinking>", re.DOTALL)
+
+# 复用与后端的HTTP连接(Keep-Alive), 避免每次请求都重新建立TCP/TLS连接
+_SESSION = requests.Session()
+_SESSION.headers.update({'Connection': 'keep-alive'})
+# 对连接失败和网关类5xx错误做带退避的重试; 重试用尽后返回最后的响应, 由调用方按状态码处理.
+# 读取超时和5xx只重试GET: POST(生成回复等)可能已被后端处理, 重发会重复执行.
+# 连接失败时请求还没有发出, urllib3对任何方法都会重试
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                         status_forcelist=(502, 503, 504),
+                                         allowed_methods=frozenset(['GET']),
+                                         raise_on_status=False))
+_SESSION.mount('http://', _adapter)
+_SESSION.mount('https://', _adapter)
+# (连接超时, 读取超时); 流式输出不限制读取时间, 避免截断较长的生成
+LIST_TIMEOUT = (3, 30)
+REQUEST_TIMEOUT = (3, 60)
+STREAM_TIMEOUT = (3, None)
+
+# 模型列表和MCP服务器列表在会话期间基本不变, 按用户缓存一段时间避免重复请求后端
+CATALOG_CACHE_TTL = 60
+CATALOG_CACHE_SIZE = 1024
+# 后端的模型列表与用户无关, 所有用户共用一个缓存项; 服务器列表包含用户自己添加的服务器, 按用户缓存
+MODELS_CACHE_KEY = "_all"
+_models_cache = {}
+_servers_cache = {}
+_catalog_cache_lock = threading.Lock()
+# 正在进行中的后端请求, 用于合并并发的相同请求
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# 相同邮件(同一模型和system prompt)的AI回复缓存, 命中时跳过整次模型调用
+RESPONSE_CACHE_SIZE = 512
+# 邮件回复使用的system prompt, 回复生成和界面默认值共用同一份
+EMAIL_SYSTEM_PROMPT = """You are an advanced email customer service expert for LSCS, specializing in processing product inquiries and generating price quotes. Your primary functions include:
+
+1. Extracting product codes and quantities from customer emails
+2. Responding professionally to customer inquiries about product availability and pricing
+
+Respond to customers in a helpful, professional manner while ensuring all pricing information is accurate and clearly presented."""
+# 固定的system prompt后加cachePoint, 支持的模型会从prompt缓存中读取这部分; 只构建一次
+EMAIL_SYSTEM_BLOCKS = [{"text": EMAIL_SYSTEM_PROMPT}, {"cachePoint": {"type": "default"}}]
+# 邮件回复通常只有几百token, 较小的输出上限可以降低排队和首字延迟
+AI_RESPONSE_MAX_TOKENS = 512
+# 批量回复时同时进行的模型调用数
+BATCH_RESPONSE_CONCURRENCY = 8
+# 措辞不同但内容相近的邮件按词频余弦相似度复用回复; 邮件中的数字(产品编号、数量)必须完全一致
+SIMILAR_RESPONSE_THRESHOLD = 0.92
+_WORD_RE = re.compile(r"\w+")
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _catalog_cache_get(cache, user_id):
+    """Return the cached value for user_id, or None if missing or expired"""
+    with _catalog_cache_lock:
+        entry = cache.get(user_id)
+        if entry and time.monotonic() - entry[0] < CATALOG_CACHE_TTL:
+            return entry[1]
+        return None
+
+def _catalog_cache_set(cache, user_id, value):
+    """Store value for user_id, evicting the oldest entry when the cache is full"""
+    with _catalog_cache_lock:
+        cache.pop(user_id, None)
+        if len(cache) >= CATALOG_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[user_id] = (time.monotonic(), value)
 
 # Email account management
 def load_email_accounts():
-    """Load email accounts from the configuration file"""
+    """Load email accounts from the configuration file
+
+    Accounts are indexed by username in memory ("accounts_by_user"); the file
+    keeps the list layout.
+    """
     try:
+        mtime = os.stat(EMAIL_ACCOUNTS_PATH).st_mtime_ns
+        # 文件未被修改时直接返回缓存的副本, 不再重新读取和解析
+        if mtime == _accounts_cache["mtime"]:
+            return copy.deepcopy(_accounts_cache["data"])
         with open(EMAIL_ACCOUNTS_PATH, "r") as f:
-            return json.load(f)
+            file_data = json.load(f)
+        accounts_data = {
+            "accounts_by_user": {account["username"]: account for account in file_data.get("accounts", [])},
+            "current_account": file_data.get("current_account")
+        }
+        _accounts_cache.update(mtime=mtime, data=accounts_data)
+        return copy.deepcopy(accounts_data)
     except (FileNotFoundError, json.JSONDecodeError):
         # Create default structure if file doesn't exist or is invalid
         default_accounts = {
-            "accounts": [],
+            "accounts_by_user": {},
             "current_account": None
         }
         save_email_accounts(default_accounts)
@@ -58,20 +187,25 @@ def load_email_accounts():
 
 def save_email_accounts(accounts_data):
     """Save email accounts to the configuration file"""
+    file_data = {
+        "accounts": list(accounts_data["accounts_by_user"].values()),
+        "current_account": accounts_data["current_account"]
+    }
     with open(EMAIL_ACCOUNTS_PATH, "w") as f:
-        json.dump(accounts_data, f, indent=2)
+        json.dump(file_data, f, indent=2)
+    _accounts_cache.update(mtime=os.stat(EMAIL_ACCOUNTS_PATH).st_mtime_ns, data=copy.deepcopy(accounts_data))
 
 def add_email_account(username, password, imap_server, imap_port, use_ssl=True):
-    """Add a new email account"""
+    """Add a new email account, returning (status, message, updated accounts data)"""
     accounts_data = load_email_accounts()
+    accounts_by_user = accounts_data["accounts_by_user"]
     
     # Check if account already exists
-    for account in accounts_data["accounts"]:
-        if account["username"] == username:
-            return False, f"Account {username} already exists"
+    if username in accounts_by_user:
+        return False, f"Account {username} already exists", accounts_data
     
     # Add the new account
-    new_account = {
+    accounts_by_user[username] = {
         "id": username,
         "username": username,
         "password": password,
@@ -80,57 +214,41 @@ def add_email_account(username, password, imap_server, imap_port, use_ssl=True):
         "use_ssl": use_ssl
     }
     
-    accounts_data["accounts"].append(new_account)
-    
     # If this is the first account, set it as the current account
     if accounts_data["current_account"] is None:
         accounts_data["current_account"] = username
     
     save_email_accounts(accounts_data)
-    return True, f"Account {username} added successfully"
+    return True, f"Account {username} added successfully", accounts_data
 
 def delete_email_account(username):
-    """Delete an email account"""
+    """Delete an email account, returning (status, message, updated accounts data)"""
     accounts_data = load_email_accounts()
+    accounts_by_user = accounts_data["accounts_by_user"]
     
-    # Find the account to delete
-    account_found = False
-    for i, account in enumerate(accounts_data["accounts"]):
-        if account["username"] == username:
-            accounts_data["accounts"].pop(i)
-            account_found = True
-            break
-    
-    if not account_found:
-        return False, f"Account {username} not found"
+    if username not in accounts_by_user:
+        return False, f"Account {username} not found", accounts_data
+    del accounts_by_user[username]
     
     # Update current account if needed
     if accounts_data["current_account"] == username:
-        if accounts_data["accounts"]:
-            accounts_data["current_account"] = accounts_data["accounts"][0]["username"]
-        else:
-            accounts_data["current_account"] = None
+        accounts_data["current_account"] = next(iter(accounts_by_user), None)
     
     save_email_accounts(accounts_data)
-    return True, f"Account {username} deleted successfully"
+    close_imap_sessions(username)
+    return True, f"Account {username} deleted successfully", accounts_data
 
 def set_current_account(username):
-    """Set an account as the current account"""
+    """Set an account as the current account, returning (status, message, updated accounts data)"""
     accounts_data = load_email_accounts()
     
     # Check if account exists
-    account_found = False
-    for account in accounts_data["accounts"]:
-        if account["username"] == username:
-            account_found = True
-            break
-    
-    if not account_found:
-        return False, f"Account {username} not found"
+    if username not in accounts_data["accounts_by_user"]:
+        return False, f"Account {username} not found", accounts_data
     
     accounts_data["current_account"] = username
     save_email_accounts(accounts_data)
-    return True, f"Current account set to {username}"
+    return True, f"Current account set to {username}", accounts_data
 
 def get_current_account():
     """Get the current account configuration"""
@@ -140,20 +258,413 @@ def get_current_account():
     if current_account_id is None:
         return None
     
-    for account in accounts_data["accounts"]:
-        if account["username"] == current_account_id:
-            return account
-    
-    return None
+    return accounts_data["accounts_by_user"].get(current_account_id)
 
 def is_gmail_account(account):
     """Check if an account is a Gmail account"""
     return account["imap_server"].lower() == "imap.gmail.com"
 
+def _decode_part_payload(part):
+    """Decode a MIME part's payload to bytes, decoding base64 directly when possible"""
+    if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        payload = part.get_payload()
+        if isinstance(payload, str):
+            try:
+                return _b64.b64decode(payload, validate=False)
+            except ValueError:
+                # 填充不正确等情况交给标准库, 它会尽量容错解码
+                pass
+    return part.get_payload(decode=True)
+
+def _parse_email_headers(msg):
+    """Return (subject, sender, date string) from a parsed message's headers"""
+    # Decode the subject, joining every encoded-word piece
+    subject_header = msg.get("Subject", "")
+    try:
+        subject = str(email.header.make_header(email.header.decode_header(subject_header))) if subject_header else ""
+    except (LookupError, UnicodeDecodeError):
+        # 未知或错误的字符集, 保留原始头部内容
+        subject = str(subject_header)
+    
+    # Get the sender
+    sender = ""
+    from_header = msg.get("From", "")
+    if from_header:
+        sender_name, sender_addr = email.utils.parseaddr(from_header)
+        if sender_name:
+            sender = sender_name
+        else:
+            sender = sender_addr
+    
+    # Get the date
+    date_header = msg.get("Date", "")
+    date = email.utils.parsedate_to_datetime(date_header) if date_header else None
+    date_str = date.strftime("%Y-%m-%d %H:%M:%S") if date else "Unknown"
+    
+    return subject, sender, date_str
+
+def _email_dict(msg_id, subject, sender, date_str, body):
+    return {
+        "id": msg_id.decode("utf-8"),
+        "subject": subject,
+        "sender": sender,
+        "date": date_str,
+        "body": body
+    }
+
+def parse_body_on_demand(raw_email):
+    """Decode the first text/plain body of a raw RFC822 message"""
+    # Parse the email
+    msg = email.message_from_bytes(raw_email)
+    
+    # Get the email body
+    body = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type == "text/plain":
+                try:
+                    body = _decode_part_payload(part).decode("utf-8", errors="replace")
+                    break
+                except Exception as e:
+                    logging.error(f"Error decoding email part: {str(e)}")
+                    body = f"Error decoding email: {str(e)}"
+    else:
+        try:
+            body = _decode_part_payload(msg).decode("utf-8", errors="replace")
+        except Exception as e:
+            logging.error(f"Error decoding email body: {str(e)}")
+            body = f"Error decoding email: {str(e)}"
+    
+    return body
+
+def _parse_imap_list(data):
+    """Parse an IMAP parenthesized list (e.g. a BODYSTRUCTURE) into nested Python lists"""
+    stack = [[]]
+    for token in _IMAP_TOKEN_RE.findall(data):
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) < 2:
+                raise ValueError("unbalanced parentheses")
+            item = stack.pop()
+            stack[-1].append(item)
+        elif token.startswith(b'"'):
+            stack[-1].append(token[1:-1].replace(b'\\"', b'"').replace(b"\\\\", b"\\"))
+        else:
+            stack[-1].append(None if token.upper() == b"NIL" else token)
+    if len(stack) != 1:
+        raise ValueError("unbalanced parentheses")
+    return stack[0]
+
+def _find_text_plain_section(structure, prefix=""):
+    """Return (section, transfer encoding) of the body part to show, or None if there is none
+
+    That is the first text/plain part of a multipart message, or the single body of a
+    non-multipart message whatever its type, the same part parse_body_on_demand decodes.
+    """
+    if structure and isinstance(structure[0], list):
+        # multipart: 子部分在前, 之后是子类型和扩展字段
+        for index, part in enumerate(structure, 1):
+            if not isinstance(part, list):
+                break
+            found = _find_text_plain_section(part, f"{prefix}{index}.")
+            if found:
+                return found
+        return None
+    if len(structure) <= 5:
+        return None
+    encoding = structure[5].lower() if isinstance(structure[5], bytes) else b"7bit"
+    if not prefix:
+        # 非multipart邮件(如只有HTML)的正文是第1部分, 与完整下载时一样直接解码
+        return "1", encoding
+    if (isinstance(structure[0], bytes) and isinstance(structure[1], bytes)
+            and structure[0].lower() == b"text" and structure[1].lower() == b"plain"):
+        return prefix.rstrip("."), encoding
+    return None
+
+def _decode_section(data, encoding):
+    """Decode a body section fetched over IMAP according to its transfer encoding"""
+    if encoding == b"base64":
+        try:
+            return _b64.b64decode(data, validate=False)
+        except ValueError:
+            # 填充不正确等情况交给email模块, 它会尽量容错解码
+            part = email.message.Message()
+            part["Content-Transfer-Encoding"] = "base64"
+            part.set_payload(data.decode("ascii", errors="surrogateescape"))
+            return part.get_payload(decode=True)
+    if encoding == b"quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+def _fetch_header_fields(mail, msg_ids):
+    """Fetch only the Subject/From/Date headers and UID of each message
+
+    Returns {msg_id: email dict}; the body stays empty until fetch_body is
+    called for the message the user opens.
+    """
+    status, msg_data = mail.fetch(b",".join(msg_ids), "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])")
+    if status != "OK":
+        logging.warning(f"Failed to fetch message headers: {status}")
+        return {}
+    
+    emails, msg_id = {}, None
+    for item in msg_data:
+        # 每封邮件是 (b'<seq> (UID <uid> BODY[HEADER.FIELDS ...] {size}', headers) 的元组,
+        # 有的服务器把UID放在literal之后单独的 b' UID <uid>)' 中
+        if isinstance(item, tuple):
+            head, raw_header = item
+            msg_id = head.split(None, 1)[0]
+            subject, sender, date_str = _parse_email_headers(_HEADER_PARSER.parsebytes(raw_header, headersonly=True))
+            emails[msg_id] = _email_dict(msg_id, subject, sender, date_str, "")
+        else:
+            head = item
+            if head[:1].isdigit():
+                # 没有literal的响应(邮件头为空)
+                msg_id = head.split(None, 1)[0]
+                emails[msg_id] = _email_dict(msg_id, "", "", "Unknown", "")
+        uid_match = _UID_RE.search(head)
+        if uid_match and msg_id in emails:
+            emails[msg_id]["uid"] = uid_match.group(1).decode("ascii")
+    return emails
+
+def _fetch_structure(mail, uid):
+    """Return the parsed BODYSTRUCTURE of one message, or None if it could not be parsed"""
+    status, msg_data = mail.uid("fetch", uid, "(BODYSTRUCTURE)")
+    if status != "OK":
+        return None
+    for item in msg_data:
+        # 含有literal的BODYSTRUCTURE会被imaplib拆成元组, 这类邮件直接走完整下载
+        if not isinstance(item, bytes):
+            continue
+        try:
+            attrs = _parse_imap_list(item)[1]
+            for index, value in enumerate(attrs):
+                if isinstance(value, bytes) and value.upper() == b"BODYSTRUCTURE":
+                    return attrs[index + 1]
+        except (ValueError, IndexError, TypeError):
+            continue
+    return None
+
+def _fetch_body_by_uid(mail, uid):
+    """Download and decode the text/plain body of one INBOX message"""
+    if mail.state != "SELECTED":
+        status, messages = mail.select("INBOX")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Failed to select INBOX: {messages}")
+    
+    # 按BODYSTRUCTURE只下载text/plain部分, 不下载附件等其他部分
+    structure = _fetch_structure(mail, uid)
+    if structure is not None:
+        found = _find_text_plain_section(structure)
+        if not found:
+            return ""
+        section, encoding = found
+        status, msg_data = mail.uid("fetch", uid, f"(BODY.PEEK[{section}])")
+        if status == "OK":
+            for item in msg_data:
+                if isinstance(item, tuple):
+                    return _decode_section(item[1], encoding).decode("utf-8", errors="replace")
+    
+    # 结构无法解析时下载完整原文; BODY.PEEK[]不会把邮件标记为已读
+    status, msg_data = mail.uid("fetch", uid, "(BODY.PEEK[])")
+    if status == "OK":
+        for item in msg_data:
+            if isinstance(item, tuple):
+                return parse_body_on_demand(item[1])
+    raise imaplib.IMAP4.error(f"Failed to fetch message {uid}")
+
+def _logout_quietly(mail):
+    """Log out of an IMAP connection, ignoring errors from an already broken connection"""
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+def _connect_imap(account):
+    """Connect and log in to the account's IMAP server, returning (mail, error message)"""
+    try:
+        logging.info(f"Connecting to IMAP server: {account['imap_server']}:{account['imap_port']}")
+        if account["use_ssl"]:
+            mail = imaplib.IMAP4_SSL(account["imap_server"], account["imap_port"], timeout=IMAP_TIMEOUT)
+            logging.info("Connected using SSL")
+        else:
+            mail = imaplib.IMAP4(account["imap_server"], account["imap_port"], timeout=IMAP_TIMEOUT)
+            logging.info("Connected without SSL")
+    except Exception as e:
+        logging.error(f"Error connecting to IMAP server: {str(e)}")
+        return None, f"Connection error: {str(e)}"
+    
+    # Login to the server
+    try:
+        logging.info(f"Attempting to login as: {account['username']}")
+        mail.login(account["username"], account["password"])
+        logging.info("Login successful")
+    except imaplib.IMAP4.error as e:
+        logging.error(f"IMAP login error: {str(e)}")
+        _logout_quietly(mail)
+        return None, f"Authentication error: {str(e)}"
+    return mail, None
+
+class ImapSession:
+    """A pooled, logged-in IMAP connection
+
+    imaplib connections are not thread-safe, so each use must hold lock.
+    """
+    def __init__(self, mail):
+        self.mail = mail
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+def _imap_pool_key(account):
+    return (account["imap_server"], account["imap_port"], account["username"])
+
+def acquire_imap_session(account):
+    """Return the pooled session for the account, connecting on first use
+
+    Returns (session, error message).
+    """
+    key = _imap_pool_key(account)
+    with _imap_pool_lock:
+        session = _imap_pool.get(key)
+    if session is not None:
+        return session, None
+    
+    mail, error = _connect_imap(account)
+    if error:
+        return None, error
+    session = ImapSession(mail)
+    with _imap_pool_lock:
+        # 并发时其他线程可能已经建立了连接, 保留先放入连接池的那个
+        pooled = _imap_pool.setdefault(key, session)
+    if pooled is not session:
+        _logout_quietly(mail)
+    _schedule_imap_keepalive()
+    return pooled, None
+
+def evict_imap_session(account, session=None):
+    """Remove the account's connection from the pool (only if it is still session) and log out"""
+    key = _imap_pool_key(account)
+    with _imap_pool_lock:
+        pooled = _imap_pool.get(key)
+        if pooled is None or (session is not None and pooled is not session):
+            return
+        del _imap_pool[key]
+    _logout_quietly(pooled.mail)
+
+def close_imap_sessions(username):
+    """Log out every pooled connection that belongs to username"""
+    with _imap_pool_lock:
+        keys = [key for key in _imap_pool if key[2] == username]
+        sessions = [_imap_pool.pop(key) for key in keys]
+    for session in sessions:
+        _logout_quietly(session.mail)
+
+def _imap_keepalive():
+    """Send NOOP on idle pooled connections so servers don't drop them"""
+    global _imap_keepalive_timer
+    with _imap_pool_lock:
+        _imap_keepalive_timer = None
+        sessions = list(_imap_pool.values())
+    now = time.monotonic()
+    for session in sessions:
+        # 正在使用的连接不需要保活
+        if now - session.last_used < IMAP_KEEPALIVE_IDLE or not session.lock.acquire(blocking=False):
+            continue
+        try:
+            session.mail.noop()
+            session.last_used = now
+        except Exception as e:
+            logging.info(f"Dropping idle IMAP connection: {str(e)}")
+            with _imap_pool_lock:
+                for key, pooled in list(_imap_pool.items()):
+                    if pooled is session:
+                        del _imap_pool[key]
+            _logout_quietly(session.mail)
+        finally:
+            session.lock.release()
+    _schedule_imap_keepalive()
+
+def _schedule_imap_keepalive():
+    global _imap_keepalive_timer
+    with _imap_pool_lock:
+        if _imap_keepalive_timer is not None or not _imap_pool:
+            return
+        _imap_keepalive_timer = threading.Timer(IMAP_KEEPALIVE_INTERVAL, _imap_keepalive)
+        _imap_keepalive_timer.daemon = True
+        _imap_keepalive_timer.start()
+
+def _with_imap_session(account, operation):
+    """Run operation(mail) on the account's pooled connection, reconnecting once if it was dropped
+
+    Returns (result, error message).
+    """
+    for attempt in range(2):
+        session, error = acquire_imap_session(account)
+        if error:
+            return None, error
+        try:
+            with session.lock:
+                result = operation(session.mail)
+                session.last_used = time.monotonic()
+            return result, None
+        except (imaplib.IMAP4.abort, OSError) as e:
+            # 连接已被服务器断开, 重新连接后重试一次
+            evict_imap_session(account, session)
+            if attempt:
+                raise
+            logging.warning(f"IMAP connection lost, reconnecting: {str(e)}")
+
+def _fetch_inbox(mail, max_emails):
+    """Fetch the most recent messages from INBOX over a logged-in connection"""
+    emails = []
+    
+    # Select the inbox
+    logging.info("Selecting INBOX folder")
+    status, messages = mail.select("INBOX")
+    
+    if status != "OK":
+        logging.error(f"Failed to select INBOX: {messages}")
+        return [], f"Failed to select INBOX: {messages}"
+    
+    logging.info("INBOX selected successfully")
+    
+    # Get the message IDs
+    logging.info("Searching for messages")
+    status, messages = mail.search(None, "ALL")
+    
+    if status != "OK":
+        logging.error(f"Failed to search messages: {messages}")
+        return [], f"Failed to search messages: {messages}"
+    
+    message_ids = messages[0].split()
+    logging.info(f"Found {len(message_ids)} messages")
+    
+    # Get the most recent emails
+    start_idx = max(0, len(message_ids) - max_emails)
+    recent_ids = message_ids[start_idx:]
+    recent_ids.reverse()  # Most recent first
+    logging.info(f"Processing {len(recent_ids)} recent messages")
+    
+    # 列表只显示主题/发件人/日期, 只取这几个邮件头和UID; 正文在打开邮件时由fetch_body下载
+    parsed_emails = _fetch_header_fields(mail, recent_ids) if recent_ids else {}
+    
+    for msg_id in recent_ids:
+        email_data = parsed_emails.get(msg_id)
+        if email_data is None:
+            logging.warning(f"Failed to fetch message {msg_id}")
+            continue
+        
+        emails.append(email_data)
+        logging.debug(f"Added email: {email_data['subject']}")
+    
+    logging.info(f"Successfully fetched {len(emails)} emails")
+    return emails, "Emails fetched successfully"
+
 def fetch_emails(account, max_emails=10):
     """Fetch emails from the specified account"""
     emails = []
-    mail = None
     
     try:
         # Log account details (without password)
@@ -167,6 +678,7 @@ def fetch_emails(account, max_emails=10):
             logging.info("Detected Gmail account. Using OAuth2 authentication via Gmail API.")
             try:
                 # Use gmailfetch module to fetch emails from Gmail
+                from gmailfetch.gmailfetch import get_complete_emails
                 gmail_emails = get_complete_emails(count=max_emails, display=False)
                 
                 if gmail_emails:
@@ -192,142 +704,34 @@ def fetch_emails(account, max_emails=10):
                 logging.warning("Falling back to standard IMAP for Gmail")
                 # Continue with standard IMAP as fallback
         
-        # Standard IMAP authentication for non-Gmail accounts or as fallback
-        try:
-            logging.info(f"Connecting to IMAP server: {account['imap_server']}:{account['imap_port']}")
-            if account["use_ssl"]:
-                mail = imaplib.IMAP4_SSL(account["imap_server"], account["imap_port"])
-                logging.info("Connected using SSL")
-            else:
-                mail = imaplib.IMAP4(account["imap_server"], account["imap_port"])
-                logging.info("Connected without SSL")
-        except Exception as e:
-            logging.error(f"Error connecting to IMAP server: {str(e)}")
-            return [], f"Connection error: {str(e)}"
-        
-        # Login to the server
-        try:
-            logging.info(f"Attempting to login as: {account['username']}")
-            mail.login(account["username"], account["password"])
-            logging.info("Login successful")
-        except imaplib.IMAP4.error as e:
-            logging.error(f"IMAP login error: {str(e)}")
-            if mail:
-                try:
-                    mail.logout()
-                except:
-                    pass
-            return [], f"Authentication error: {str(e)}"
-        
-        # Select the inbox
-        logging.info("Selecting INBOX folder")
-        status, messages = mail.select("INBOX")
-        
-        if status != "OK":
-            logging.error(f"Failed to select INBOX: {messages}")
-            return [], f"Failed to select INBOX: {messages}"
-        
-        logging.info("INBOX selected successfully")
-        
-        # Get the message IDs
-        logging.info("Searching for messages")
-        status, messages = mail.search(None, "ALL")
-        
-        if status != "OK":
-            logging.error(f"Failed to search messages: {messages}")
-            return [], f"Failed to search messages: {messages}"
-        
-        message_ids = messages[0].split()
-        logging.info(f"Found {len(message_ids)} messages")
-        
-        # Get the most recent emails
-        start_idx = max(0, len(message_ids) - max_emails)
-        recent_ids = message_ids[start_idx:]
-        recent_ids.reverse()  # Most recent first
-        logging.info(f"Processing {len(recent_ids)} recent messages")
-        
-        for msg_id in recent_ids:
-            logging.debug(f"Fetching message ID: {msg_id}")
-            status, msg_data = mail.fetch(msg_id, "(RFC822)")
-            
-            if status != "OK":
-                logging.warning(f"Failed to fetch message {msg_id}: {status}")
-                continue
-            
-            # Parse the email
-            raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
-            
-            # Decode the subject
-            subject = ""
-            subject_header = msg.get("Subject", "")
-            if subject_header:
-                decoded_header = email.header.decode_header(subject_header)
-                subject = decoded_header[0][0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode("utf-8", errors="replace")
-            
-            # Get the sender
-            sender = ""
-            from_header = msg.get("From", "")
-            if from_header:
-                sender_name, sender_addr = email.utils.parseaddr(from_header)
-                if sender_name:
-                    sender = sender_name
-                else:
-                    sender = sender_addr
-            
-            # Get the date
-            date_header = msg.get("Date", "")
-            date = email.utils.parsedate_to_datetime(date_header) if date_header else None
-            date_str = date.strftime("%Y-%m-%d %H:%M:%S") if date else "Unknown"
-            
-            # Get the email body
-            body = ""
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type == "text/plain":
-                        try:
-                            body = part.get_payload(decode=True).decode("utf-8", errors="replace")
-                            break
-                        except Exception as e:
-                            logging.error(f"Error decoding email part: {str(e)}")
-                            body = f"Error decoding email: {str(e)}"
-            else:
-                try:
-                    body = msg.get_payload(decode=True).decode("utf-8", errors="replace")
-                except Exception as e:
-                    logging.error(f"Error decoding email body: {str(e)}")
-                    body = f"Error decoding email: {str(e)}"
-            
-            # Add the email to the list
-            emails.append({
-                "id": msg_id.decode("utf-8"),
-                "subject": subject,
-                "sender": sender,
-                "date": date_str,
-                "body": body
-            })
-            logging.debug(f"Added email: {subject}")
-        
-        # Close the connection
-        logging.info("Closing IMAP connection")
-        mail.close()
-        mail.logout()
-        
-        logging.info(f"Successfully fetched {len(emails)} emails")
-        return emails, "Emails fetched successfully"
+        # Standard IMAP for non-Gmail accounts or as fallback, over a pooled connection
+        result, error = _with_imap_session(account, lambda mail: _fetch_inbox(mail, max_emails))
+        if error:
+            return [], error
+        # 记下来源账户, 之后切换了当前账户也从原账户下载正文
+        for email_item in result[0]:
+            email_item["account"] = account["username"]
+        return result
     
     except Exception as e:
         logging.exception(f"Error in fetch_emails: {str(e)}")
-        if mail:
-            try:
-                mail.logout()
-            except:
-                pass
+        evict_imap_session(account)
         return [], f"Error fetching emails: {str(e)}"
 
+def _email_account(email_item):
+    """Return the configuration of the account an email was listed from, or None if it is gone"""
+    return load_email_accounts()["accounts_by_user"].get(email_item.get("account"))
+
+def fetch_body(account, uid):
+    """Download the body of one IMAP message by UID, returning (body, error message)"""
+    try:
+        logging.info(f"Fetching body of message {uid} for: {account['username']}")
+        return _with_imap_session(account, lambda mail: _fetch_body_by_uid(mail, uid))
+    except Exception as e:
+        logging.exception(f"Error in fetch_body: {str(e)}")
+        evict_imap_session(account)
+        return None, str(e)
+
 # 用户会话管理
 def get_user_id(request: gr.Request = None):
     """获取或生成用户ID"""
@@ -341,16 +745,46 @@ def get_user_id(request: gr.Request = None):
     
     return user_id
 
+@functools.lru_cache(maxsize=256)
 def get_auth_headers(user_id):
-    """构建包含用户身份的认证头"""
-    headers = {
+    """构建包含用户身份的认证头(只读, 按用户缓存)"""
+    return MappingProxyType({
         'Authorization': f'Bearer {API_KEY}',
         'X-User-ID': user_id
-    }
-    return headers
+    })
 
-def request_list_models(user_id):
-    url = mcp_base_url.rstrip('/') + '/v1/list/models'
+@functools.lru_cache(maxsize=256)
+def get_json_headers(user_id):
+    """构建发送预序列化JSON请求体时使用的请求头(只读, 按用户缓存)"""
+    return MappingProxyType({**get_auth_headers(user_id), 'Content-Type': 'application/json'})
+
+def _single_flight(key, fn, *args):
+    """同一key的并发调用只执行一次fn, 其余调用等待并共享同一结果"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+    return future.result()
+
+def request_list_models(user_id, refresh=False):
+    if not refresh:
+        models = _catalog_cache_get(_models_cache, MODELS_CACHE_KEY)
+        if models is not None:
+            return models
+    return _single_flight(('models',), _fetch_models, user_id)
+
+def _fetch_models(user_id):
+    url = URL_LIST_MODELS
     models = []
     try:
         logging.info(f'Requesting models list for user: {user_id}')
@@ -359,7 +793,7 @@ def request_list_models(user_id):
         logging.info(f'Request URL: {url}')
         
         # Add timeout to prevent hanging
-        response = requests.get(url, headers=headers, timeout=10)
+        response = _SESSION.get(url, headers=headers, timeout=LIST_TIMEOUT)
         logging.info(f'Response status code: {response.status_code}')
         
         if response.status_code != 200:
@@ -394,21 +828,46 @@ def request_list_models(user_id):
             {"model_id": "us.amazon.nova-pro-v1:0", "model_name": "Amazon Nova Pro v1"}
         ]
         
+    _catalog_cache_set(_models_cache, MODELS_CACHE_KEY, models)
     return models
 
+def _warm_catalog_cache(stop_event):
+    """后台定期刷新模型列表缓存, 新会话加载页面时无需等待后端请求"""
+    while True:
+        request_list_models('_warmup', refresh=True)
+        # 在缓存过期前刷新, 稳定状态下init_data不会未命中
+        if stop_event.wait(CATALOG_CACHE_TTL / 2):
+            break
+
+_catalog_warmer_stop = None
+
+def start_catalog_warmer():
+    """启动模型列表的后台预取线程(只启动一次)"""
+    global _catalog_warmer_stop
+    if _catalog_warmer_stop is None:
+        _catalog_warmer_stop = threading.Event()
+        threading.Thread(target=_warm_catalog_cache, args=(_catalog_warmer_stop,), daemon=True).start()
+
 def request_list_mcp_servers(user_id):
-    url = mcp_base_url.rstrip('/') + '/v1/list/mcp_server'
+    mcp_servers = _catalog_cache_get(_servers_cache, user_id)
+    if mcp_servers is not None:
+        return mcp_servers
+    return _single_flight(('servers', user_id), _fetch_mcp_servers, user_id)
+
+def _fetch_mcp_servers(user_id):
+    url = URL_LIST_MCP_SERVERS
     mcp_servers = []
     try:
-        response = requests.get(url, headers=get_auth_headers(user_id))
+        response = _SESSION.get(url, headers=get_auth_headers(user_id), timeout=LIST_TIMEOUT)
         data = response.json()
         mcp_servers = data.get('servers', [])
+        _catalog_cache_set(_servers_cache, user_id, mcp_servers)
     except Exception as e:
         logging.error('request list mcp servers error: %s' % e)
     return mcp_servers
 
 def request_add_mcp_server(user_id, server_id, server_name, command, args=[], env=None, config_json={}):
-    url = mcp_base_url.rstrip('/') + '/v1/add/mcp_server'
+    url = URL_ADD_MCP_SERVER
     status = False
     try:
         payload = {
@@ -420,7 +879,8 @@ def request_add_mcp_server(user_id, server_id, server_name, command, args=[], en
         }
         if env:
             payload["env"] = env
-        response = requests.post(url, json=payload, headers=get_auth_headers(user_id))
+        response = _SESSION.post(url, data=orjson.dumps(payload), headers=get_json_headers(user_id),
+                                 timeout=REQUEST_TIMEOUT)
         data = response.json()
         status = data['errno'] == 0
         msg = data['msg']
@@ -429,34 +889,54 @@ def request_add_mcp_server(user_id, server_id, server_name, command, args=[], en
         logging.error('request add mcp servers error: %s' % e)
     return status, msg
 
+def _iter_sse(response):
+    """Yield raw SSE lines as soon as each newline arrives"""
+    buf = bytearray()
+    # chunk_size=None按服务端发送的分块返回数据, 不会为凑满固定大小而等待
+    for chunk in response.iter_content(chunk_size=None):
+        buf.extend(chunk)
+        start = 0
+        while (i := buf.find(b'\n', start)) != -1:
+            yield bytes(buf[start:i]).rstrip(b'\r')
+            start = i + 1
+        del buf[:start]
+    if buf:
+        yield bytes(buf)
+
 def process_stream_response(response):
     """Process streaming response and yield content chunks"""
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith('data: '):
-                data = line[6:]  # Remove 'data: ' prefix
-                if data == '[DONE]':
-                    break
-                try:
-                    json_data = json.loads(data)
-                    delta = json_data['choices'][0].get('delta', {})
+    try:
+        for line in _iter_sse(response):
+            # 直接按字节判断前缀, 非data行无需解码
+            if not line or not line.startswith(b'data: '):
+                continue
+            data = line[6:]  # Remove 'data: ' prefix
+            if data == b'[DONE]':
+                break
+            try:
+                choice = orjson.loads(data)['choices'][0]
+                delta = choice.get('delta')
+                if delta:
                     if 'role' in delta:
                         continue
-                    if 'content' in delta:
-                        yield delta['content']
-                    
-                    message_extras = json_data['choices'][0].get('message_extras', {})
-                    if "tool_use" in message_extras:
-                        yield f"<tool_use>{message_extras['tool_use']}</tool_use>"
+                    content = delta.get('content')
+                    if content is not None:
+                        yield content
+                
+                message_extras = choice.get('message_extras')
+                if message_extras and "tool_use" in message_extras:
+                    yield f"<tool_use>{message_extras['tool_use']}</tool_use>"
 
-                except json.JSONDecodeError:
-                    logging.error(f"Failed to parse JSON: {data}")
-                except Exception as e:
-                    logging.error(f"Error processing stream: {e}")
+            except orjson.JSONDecodeError:
+                logging.error(f"Failed to parse JSON: {data!r}")
+            except Exception as e:
+                logging.error(f"Error processing stream: {e}")
+    finally:
+        # 读完后释放连接, 使其回到连接池复用
+        response.close()
 
 def request_chat(user_id, messages, model_id, mcp_server_ids, stream=True, max_tokens=1024, temperature=0.6, extra_params={}):
-    url = mcp_base_url.rstrip('/') + '/v1/chat/completions'
+    url = URL_CHAT
     msg, msg_extras = 'something is wrong!', {}
     try:
         payload = {
@@ -468,22 +948,25 @@ def request_chat(user_id, messages, model_id, mcp_server_ids, stream=True, max_t
             'temperature': temperature,
             'max_tokens': max_tokens
         }
-        logging.info(f'用户 {user_id} 请求payload: %s' % payload)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('用户 %s 请求payload: %s', user_id, payload)
         
         if stream:
             # 流式请求
-            headers = get_auth_headers(user_id)
-            headers['Accept'] = 'text/event-stream'  
-            response = requests.post(url, json=payload, stream=True, headers=headers)
+            headers = {**get_json_headers(user_id), 'Accept': 'text/event-stream'}
+            response = _SESSION.post(url, data=orjson.dumps(payload), stream=True, headers=headers,
+                                     timeout=STREAM_TIMEOUT)
             
             if response.status_code == 200:
                 return response, {}
             else:
+                response.close()
                 msg = 'An error occurred when calling the Converse operation: The system encountered an unexpected error during processing. Try your request again.'
                 logging.error(f'用户 {user_id} 请求聊天错误: %d' % response.status_code)
         else:
             # 常规请求
-            response = requests.post(url, json=payload, headers=get_auth_headers(user_id))
+            response = _SESSION.post(url, data=orjson.dumps(payload), headers=get_json_headers(user_id),
+                                     timeout=REQUEST_TIMEOUT)
             data = response.json()
             msg = data['choices'][0]['message']['content']
             msg_extras = data['choices'][0]['message_extras']
@@ -492,9 +975,16 @@ def request_chat(user_id, messages, model_id, mcp_server_ids, stream=True, max_t
         msg = 'An error occurred when calling the Converse operation: The system encountered an unexpected error during processing. Try your request again.'
         logging.error(f'用户 {user_id} 请求聊天错误: %s' % e)
     
-    logging.info(f'用户 {user_id} 响应消息: %s' % msg)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('用户 %s 响应消息: %s', user_id, msg)
     return msg, msg_extras
 
+def _parse_json(value):
+    """解析JSON字符串, 已经是dict时直接返回"""
+    if isinstance(value, dict):
+        return value
+    return orjson.loads(value) if value else {}
+
 def add_new_mcp_server(user_id, server_name, server_id, server_cmd, server_args, server_env, server_config_json):
     status, msg = True, "The server already been added!"
     config_json = {}
@@ -505,38 +995,36 @@ def add_new_mcp_server(user_id, server_name, server_id, server_cmd, server_args,
     # 如果server_config_json配置，则已server_config_json为准
     if server_config_json:
         try:
-            config_json = json.loads(server_config_json)
-            if not all([isinstance(k, str) for k in config_json.keys()]):
-                raise ValueError("env key must be str.")
-            if "mcpServers" in config_json:
-                config_json = config_json["mcpServers"]
+            config_json = _parse_json(server_config_json)
+            if not isinstance(config_json, dict):
+                raise ValueError("config must be a JSON dict.")
+            config_json = config_json.get("mcpServers", config_json)
             # 直接使用json配置里的id
             logging.info(f'用户 {user_id} 添加新MCP服务器: {config_json}')
-            server_id = list(config_json.keys())[0]
+            server_id = next(iter(config_json))
             server_cmd = config_json[server_id]["command"]
             server_args = config_json[server_id]["args"]
             server_env = config_json[server_id].get('env')
-        except Exception as e:
+        except (ValueError, KeyError, TypeError, AttributeError, StopIteration):
             status, msg = False, "The config must be a valid JSON."
 
-    if not re.match(r'^[a-zA-Z][a-zA-Z0-9_]*$', server_id):
+    if not _SERVER_ID_RE.match(server_id):
         status, msg = False, "The server id must be a valid variable name!"
-    elif not server_cmd or server_cmd not in mcp_command_list:
+    elif not server_cmd or server_cmd not in _MCP_CMDS:
         status, msg = False, "The server command is invalid!"
     
     if server_env:
         try:
-            server_env = json.loads(server_env) if not isinstance(server_env, dict) else server_env
-            if not all([isinstance(k, str) for k in server_env.keys()]):
-                raise ValueError("env key must be str.")
-            if not all([isinstance(v, str) for v in server_env.values()]):
-                raise ValueError("env value must be str.")
-        except Exception as e:
+            server_env = _parse_json(server_env)
+            if not isinstance(server_env, dict) or not all(
+                    isinstance(k, str) and isinstance(v, str) for k, v in server_env.items()):
+                raise ValueError("env must be a dict[str, str].")
+        except ValueError:
             server_env = {}
             status, msg = False, "The server env must be a JSON dict[str, str]."
     
     if isinstance(server_args, str):
-        server_args = [x.strip() for x in server_args.split(' ') if x.strip()]
+        server_args = server_args.split()
 
     logging.info(f'用户 {user_id} 添加新MCP服务器: {server_id}:{server_name}')
     
@@ -546,22 +1034,125 @@ def add_new_mcp_server(user_id, server_name, server_id, server_cmd, server_args,
     
     return status, msg
 
-def chat_function(user_id, message, history, model_name, model_id_map, mcp_servers, selected_servers, 
-                  system_prompt, max_tokens, budget_tokens, temperature, n_recent_images, enable_thinking, enable_stream):
-    """处理聊天功能"""
+class StreamTagParser:
+    """按到达顺序把流式文本拆成正文、thinking和tool_use三部分
+
+    每个片段只扫描一次, 不再对累积的整个响应反复执行正则
+    """
+    TAGS = {"<thinking>": "thinking", "<tool_use>": "tool_use"}
+    MAX_TAG_LEN = max(map(len, TAGS))
+
+    def __init__(self):
+        self.visible = []
+        self.thinking = ""
+        self.tool_uses = []
+        self._inside = None
+        self._open_tag = ""
+        self._tag_parts = []
+        self._pending = ""
+
+    def feed(self, chunk):
+        """处理一个片段, 返回thinking或tool_use是否有更新"""
+        text, self._pending = self._pending + chunk, ""
+        changed = False
+        pos = 0
+        while pos < len(text):
+            if self._inside is None:
+                i = text.find("<", pos)
+                if i == -1:
+                    self.visible.append(text[pos:])
+                    break
+                if i > pos:
+                    self.visible.append(text[pos:i])
+                rest = text[i:i + self.MAX_TAG_LEN]
+                for tag, name in self.TAGS.items():
+                    if rest.startswith(tag):
+                        self._inside, self._open_tag = name, tag
+                        pos = i + len(tag)
+                        break
+                else:
+                    if any(tag.startswith(rest) for tag in self.TAGS) and i + len(rest) == len(text):
+                        # 片段末尾可能是被截断的开始标签, 留到下个片段再判断
+                        self._pending = text[i:]
+                        break
+                    self.visible.append("<")
+                    pos = i + 1
+            else:
+                end_tag = f"</{self._inside}>"
+                j = text.find(end_tag, pos)
+                if j == -1:
+                    k = text.rfind("<", pos)
+                    if k != -1 and end_tag.startswith(text[k:]):
+                        self._tag_parts.append(text[pos:k])
+                        self._pending = text[k:]
+                    else:
+                        self._tag_parts.append(text[pos:])
+                    break
+                self._tag_parts.append(text[pos:j])
+                block = "".join(self._tag_parts)
+                if self._inside == "thinking":
+                    self.thinking = block
+                else:
+                    self.tool_uses.append(block)
+                self._inside, self._tag_parts = None, []
+                changed = True
+                pos = j + len(end_tag)
+        return changed
+
+    def close(self):
+        """流结束时把未闭合的标签内容按原样放回正文"""
+        if self._inside is not None:
+            self.visible.append(self._open_tag)
+            self.visible.extend(self._tag_parts)
+            self._inside, self._tag_parts = None, []
+        if self._pending:
+            self.visible.append(self._pending)
+            self._pending = ""
+
+    @property
+    def text(self):
+        return "".join(self.visible)
+
+def dump_tool_use(tool_use_content):
+    """把tool_use列表格式化为缩进的JSON文本(非ASCII字符原样输出)"""
+    return orjson.dumps(tool_use_content, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+def _build_messages(message_buffer, system_prompt, history):
+    """复用已有的消息缓冲区, 只有system prompt或历史不一致时才重建
+
+    只保留最近MAX_HISTORY_TURNS轮对话, 避免发送给后端的上下文无限增长
+    """
+    history = history[-MAX_HISTORY_TURNS:]
+    expected = 1 + 2 * len(history)
+    excess = len(message_buffer) - expected
+    if excess > 0 and excess % 2 == 0:
+        # 超出上限时丢弃最早的几轮, 不必重建整个列表
+        del message_buffer[1:1 + excess]
+    if len(message_buffer) != expected or message_buffer[0]["content"] != system_prompt:
+        message_buffer[:] = chain(
+            [{"role": "system", "content": system_prompt}],
+            chain.from_iterable(
+                ({"role": "user", "content": user_msg}, {"role": "assistant", "content": bot_msg})
+                for user_msg, bot_msg in history
+            )
+        )
+    return message_buffer
+
+def chat_function(user_id, message, history, model_name, model_id_map, server_id_by_name, selected_servers, 
+                  system_prompt, max_tokens, budget_tokens, temperature, n_recent_images, enable_thinking, enable_stream,
+                  message_buffer=None):
+    """处理聊天功能
+
+    message_buffer是保存在gr.State中的消息列表, 每轮只追加新消息而不是重建整个列表
+    """
     # 构建消息列表
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # 添加历史消息
-    for user_msg, bot_msg in history:
-        messages.append({"role": "user", "content": user_msg})
-        messages.append({"role": "assistant", "content": bot_msg})
+    messages = _build_messages([] if message_buffer is None else message_buffer, system_prompt, history)
     
     # 添加当前用户消息
     messages.append({"role": "user", "content": message})
     
     # 获取选中的MCP服务器ID
-    mcp_server_ids = [mcp_servers[server]["server_id"] for server in selected_servers]
+    mcp_server_ids = [server_id_by_name[server] for server in selected_servers]
     
     # 获取模型ID
     model_id = model_id_map[model_name]
@@ -586,52 +1177,65 @@ def chat_function(user_id, message, history, model_name, model_id_map, mcp_serve
     
     # 处理流式响应
     if enable_stream and isinstance(response, requests.Response):
+        parser = StreamTagParser()
+        # 首次输出需要刷新全部组件, 清掉上一轮的thinking/tool_use内容
+        secondary_dirty = True
+        pending_chunks = 0
+        last_yield = time.monotonic()
         for content in process_stream_response(response):
-            full_response += content
+            # 只有thinking或tool_use块闭合时才需要更新对应内容并重新序列化
+            if parser.feed(content):
+                thinking_content = parser.thinking
+                tool_use_content = parser.tool_uses
+                secondary_dirty = True
             
-            # 处理thinking内容
-            thk_regex = r"<thinking>(.*?)</thinking>"
-            thk_m = re.search(thk_regex, full_response, re.DOTALL)
-            if thk_m:
-                thinking_content = thk_m.group(1)
-                full_response = re.sub(thk_regex, "", full_response, flags=re.DOTALL)
-            
-            # 处理tool_use内容
-            tooluse_regex = r"<tool_use>(.*?)</tool_use>"
-            tool_m = re.search(tooluse_regex, full_response, re.DOTALL)
-            if tool_m:
-                tool_msg = tool_m.group(1)
-                full_response = re.sub(tooluse_regex, "", full_response)
-                tool_use_content.append(tool_msg)
+            # 攒够一批片段或超过刷新间隔才更新UI; thinking/tool_use有更新时立即刷新
+            pending_chunks += 1
+            now = time.monotonic()
+            if not secondary_dirty and pending_chunks < STREAM_YIELD_CHUNKS and now - last_yield < STREAM_YIELD_INTERVAL:
+                continue
+            pending_chunks, last_yield = 0, now
+            full_response = parser.text
             
-            # 更新UI
-            yield full_response, thinking_content, json.dumps(tool_use_content, ensure_ascii=False, indent=2)
+            # 更新UI, 未变化的组件用gr.skip()跳过, 减少推送到浏览器的数据
+            if secondary_dirty:
+                secondary_dirty = False
+                yield full_response, thinking_content, dump_tool_use(tool_use_content)
+            else:
+                yield full_response, gr.skip(), gr.skip()
+        parser.close()
+        if parser.text != full_response:
+            # 输出最后攒下的片段, 以及回到正文的未闭合标签内容
+            full_response = parser.text
+            yield full_response, gr.skip(), gr.skip()
+        messages.append({"role": "assistant", "content": full_response})
     else:
         # 处理非流式响应
         full_response = response if not isinstance(response, requests.Response) else "Error in response"
         
         # 处理thinking内容
-        thk_regex = r"<thinking>(.*?)</thinking>"
-        thk_m = re.search(thk_regex, full_response, re.DOTALL)
-        if thk_m:
+        # 先用子串查找过滤掉不含thinking标签的回复, 避免进入正则引擎
+        if "<thinking>" in full_response and (thk_m := _THINK_RE.search(full_response)):
             thinking_content = thk_m.group(1)
-            full_response = re.sub(thk_regex, "", full_response, flags=re.DOTALL)
+            full_response = _THINK_RE.sub("", full_response)
         
         # 处理tool_use内容
         if msg_extras.get('tool_use'):
-            tool_use_content.append(json.dumps(msg_extras.get('tool_use')))
+            tool_use_content.append(orjson.dumps(msg_extras['tool_use'], option=orjson.OPT_NON_STR_KEYS).decode())
         
-        yield full_response, thinking_content, json.dumps(tool_use_content, ensure_ascii=False, indent=2)
+        messages.append({"role": "assistant", "content": full_response})
+        yield full_response, thinking_content, dump_tool_use(tool_use_content)
 
 def refresh_mcp_servers(user_id):
     """刷新MCP服务器列表"""
     mcp_servers = {}
     for server in request_list_mcp_servers(user_id):
-        mcp_servers[server['server_name']] = {
-            "server_id": server['server_id'],
-            "server_desc": server.get('server_desc', server['server_name'])
-        }
-    return mcp_servers, list(mcp_servers.keys())
+        mcp_servers[server['server_name']] = ServerInfo(
+            server['server_id'], server.get('server_desc', server['server_name'])
+        )
+    # 额外返回 名称->server_id 的扁平映射, 聊天时只需一次字典查找
+    server_id_by_name = {name: info.server_id for name, info in mcp_servers.items()}
+    return mcp_servers, list(mcp_servers.keys()), server_id_by_name
 
 def refresh_models(user_id):
     """刷新模型列表"""
@@ -672,11 +1276,14 @@ def add_mcp_server_ui(user_id, server_name, server_id, server_cmd, server_args,
     )
     
     if status:
+        # 新增服务器后使缓存失效, 让新服务器立即出现在列表中
+        with _catalog_cache_lock:
+            _servers_cache.pop(user_id, None)
         # 刷新服务器列表
-        mcp_servers, server_names = refresh_mcp_servers(user_id)
-        return gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), f"✅ {msg}", mcp_servers, server_names
+        mcp_servers, server_names, server_id_by_name = refresh_mcp_servers(user_id)
+        return gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(value=""), f"✅ {msg}", mcp_servers, server_names, server_id_by_name
     else:
-        return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), f"❌ {msg}", gr.update(), gr.update()
+        return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), f"❌ {msg}", gr.update(), gr.update(), gr.update()
 
 def clear_conversation():
     """清空对话历史"""
@@ -690,6 +1297,59 @@ def save_user_id(user_id):
     """保存用户ID到cookie"""
     return user_id
 
+def _build_email_char_table():
+    table = bytearray(256)
+    for c in b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-":
+        table[c] = _EMAIL_LOCAL | _EMAIL_DOMAIN
+    for c in b"!#$%&'*+/=?^_`{|}~":
+        table[c] = _EMAIL_LOCAL
+    table[ord(".")] = _EMAIL_DOT
+    table[ord("@")] = _EMAIL_AT
+    return bytes(table)
+
+_EMAIL_LOCAL, _EMAIL_DOMAIN, _EMAIL_DOT, _EMAIL_AT = 1, 2, 4, 8
+_EMAIL_CHARS = _build_email_char_table()
+_SPECIAL_USE_TLDS = frozenset(SPECIAL_USE_DOMAIN_NAMES)
+
+def is_simple_email(address):
+    """Fast check for the common dot-atom ASCII form local@example.com
+
+    Walks the address once against a character class table. Returns False for
+    anything it does not recognise, which may still be valid (quoted local
+    parts, internationalized addresses) and is left to email_validator.
+    """
+    if not address.isascii() or len(address) > 254:
+        return False
+    data = address.encode("ascii")
+    at = -1
+    prev = _EMAIL_DOT  # 开头不能是"."
+    label_start = 0
+    for i, c in enumerate(data):
+        cls = _EMAIL_CHARS[c]
+        if cls == _EMAIL_DOT:
+            # 不能连续出现"."或紧跟在"@"之后; 域名的每个label不能以"-"结尾
+            if prev & (_EMAIL_DOT | _EMAIL_AT) or (at >= 0 and data[i - 1] == 45):
+                return False
+            label_start = i + 1
+        elif cls == _EMAIL_AT:
+            if at >= 0 or prev == _EMAIL_DOT or i == 0 or i > 64:
+                return False
+            at = label_start = i + 1
+        elif at < 0:
+            if not cls & _EMAIL_LOCAL:
+                return False
+        else:
+            if not cls & _EMAIL_DOMAIN or i - label_start >= 63:
+                return False
+            # label不能以"-"开头, 第3、4位为"--"的是IDNA保留形式
+            if c == 45 and (i == label_start or (i - label_start == 3 and data[i - 1] == 45)):
+                return False
+        prev = cls
+    # 域名至少包含两个label; 顶级域名只接受字母, 特殊用途域名(如.local)交给email_validator判断
+    tld = data[label_start:].lower()
+    return (at > 0 and label_start > at and tld.isalpha()
+            and tld.decode("ascii") not in _SPECIAL_USE_TLDS)
+
 # Email account management UI functions
 def add_email_account_ui(username, password, imap_server, imap_port, use_ssl, current_accounts):
     """UI function for adding an email account"""
@@ -697,20 +1357,21 @@ def add_email_account_ui(username, password, imap_server, imap_port, use_ssl, cu
         logging.info(f"Adding email account: {username}")
         # Validate email address
         try:
-            validate_email(username, check_deliverability=False)
+            # 常见的纯ASCII地址用查表快速校验, 其余情况交给email_validator
+            if not is_simple_email(username):
+                validate_email(username, check_deliverability=False)
         except EmailNotValidError:
             logging.error(f"Invalid email address: {username}")
             return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), f"❌ Invalid email address", current_accounts
         
         # Add account
-        status, message = add_email_account(
+        status, message, accounts_data = add_email_account(
             username, password, imap_server, imap_port, use_ssl
         )
         
         if status:
-            # Refresh account list
-            accounts_data = load_email_accounts()
-            account_names = [account["username"] for account in accounts_data["accounts"]]
+            # Refresh account list from the data that was just saved
+            account_names = list(accounts_data["accounts_by_user"])
             current_account = accounts_data["current_account"]
             logging.info(f"Account added successfully: {username}")
             
@@ -736,12 +1397,11 @@ def delete_email_account_ui(username, current_accounts):
     """UI function for deleting an email account"""
     try:
         logging.info(f"Deleting email account: {username}")
-        status, message = delete_email_account(username)
+        status, message, accounts_data = delete_email_account(username)
         
         if status:
-            # Refresh account list
-            accounts_data = load_email_accounts()
-            account_names = [account["username"] for account in accounts_data["accounts"]]
+            # Refresh account list from the data that was just saved
+            account_names = list(accounts_data["accounts_by_user"])
             current_account = accounts_data["current_account"]
             logging.info(f"Account deleted successfully: {username}")
             
@@ -757,7 +1417,7 @@ def set_current_account_ui(username):
     """UI function for setting the current account"""
     try:
         logging.info(f"Setting current account to: {username}")
-        status, message = set_current_account(username)
+        status, message, _ = set_current_account(username)
         if status:
             logging.info(f"Current account set successfully: {username}")
             return f"✅ {message}"
@@ -775,24 +1435,24 @@ def fetch_emails_ui(account_list):
         current_account = get_current_account()
         if not current_account:
             logging.warning("No account selected")
-            return None, None, None, "No account selected", gr.update(choices=[], value=None), []
+            return None, None, None, "No account selected", gr.update(choices=[], value=None), [], gr.update(choices=[], value=[])
         
         logging.info(f"Current account: {current_account['username']}")
         emails, message = fetch_emails(current_account)
         
         if not emails:
             logging.warning(f"No emails found or error occurred: {message}")
-            return None, None, None, message, gr.update(choices=[], value=None), []
+            return None, None, None, message, gr.update(choices=[], value=None), [], gr.update(choices=[], value=[])
         
         # Format emails for UI display
         email_display_list = [f"[{email['date']}] {email['subject']} (From: {email['sender']})" for email in emails]
         logging.info(f"Successfully fetched {len(emails)} emails")
         
         # Use gr.update for the Radio component
-        return current_account["username"], None, None, f"✅ {message}", gr.update(choices=email_display_list, value=None), emails
+        return current_account["username"], None, None, f"✅ {message}", gr.update(choices=email_display_list, value=None), emails, gr.update(choices=email_display_list, value=[])
     except Exception as e:
         logging.exception("Exception in fetch_emails_ui")
-        return None, None, None, f"❌ Error: {str(e)}", gr.update(choices=[], value=None), []
+        return None, None, None, f"❌ Error: {str(e)}", gr.update(choices=[], value=None), [], gr.update(choices=[], value=[])
 
 def load_email_content(emails, selected_email_display):
     """Load the content of a selected email"""
@@ -805,56 +1465,244 @@ def load_email_content(emails, selected_email_display):
         if email_display == selected_email_display:
             selected_email = email
             logging.info(f"Loading email content: {selected_email['subject']}")
+            # IMAP邮件列表只有邮件头, 第一次打开时才下载正文并缓存
+            body = selected_email["body"]
+            if not body and "uid" in selected_email:
+                source_account = _email_account(selected_email)
+                body, error = (fetch_body(source_account, selected_email["uid"]) if source_account
+                               else (None, "Account of this email is no longer configured"))
+                if error:
+                    body = f"Error loading email: {error}"
+                else:
+                    selected_email["body"] = body
             return (
                 selected_email["subject"],
                 selected_email["sender"],
-                selected_email["body"],
+                body,
                 gr.update(interactive=True)  # Enable the AI response button
             )
     
     logging.warning(f"Could not find matching email for: {selected_email_display}")
     return "", "", "", gr.update(interactive=False)
 
-async def generate_ai_response(subject, sender, body, model_name, model_id_map):
-    """Generate an AI response for an email"""
+@functools.lru_cache(maxsize=1)
+def _get_chat_client():
+    """Return the chat client shared by all requests, so its HTTP connections are reused"""
+    from src.compatible_chat_client_stream import CompatibleChatClientStream
+    return CompatibleChatClientStream()
+
+def _response_cache_key(model_id, max_tokens, system_prompt, subject, sender, body):
+    """Key identifying one email reply request, ignoring surrounding whitespace"""
+    parts = (model_id, str(int(max_tokens)), system_prompt, subject.strip(), sender.strip(), body.strip())
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def _email_fingerprint(subject, body):
+    """Return (word counts, vector norm, tokens containing digits) for similarity matching"""
+    words = _WORD_RE.findall(f"{subject}\n{body}".lower())
+    numbers = frozenset(word for word in words if any(ch.isdigit() for ch in word))
+    counts = Counter(word for word in words if word not in numbers)
+    return counts, math.sqrt(sum(n * n for n in counts.values())), numbers
+
+def _fingerprint_similarity(a, b):
+    """Cosine similarity of two fingerprints, 0 when their numbers differ"""
+    (counts_a, norm_a, numbers_a), (counts_b, norm_b, numbers_b) = a, b
+    if numbers_a != numbers_b or not norm_a or not norm_b:
+        return 0.0
+    if len(counts_a) > len(counts_b):
+        counts_a, counts_b = counts_b, counts_a
+    return sum(n * counts_b[word] for word, n in counts_a.items()) / (norm_a * norm_b)
+
+def _response_cache_get(key):
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        _response_cache.move_to_end(key)
+        return entry[2]
+
+def _response_cache_find_similar(scope, fingerprint, threshold):
+    """Return the cached reply of the most similar email under the same scope, or None"""
+    with _response_cache_lock:
+        best_key, best_score = None, threshold
+        for key, (entry_scope, entry_fingerprint, _) in _response_cache.items():
+            if entry_scope == scope:
+                score = _fingerprint_similarity(fingerprint, entry_fingerprint)
+                if score >= best_score:
+                    best_key, best_score = key, score
+        if best_key is None:
+            return None
+        _response_cache.move_to_end(best_key)
+        logging.info(f"Found similar cached email (similarity {best_score:.3f})")
+        return _response_cache[best_key][2]
+
+def _response_cache_set(key, scope, fingerprint, response_text):
+    with _response_cache_lock:
+        _response_cache[key] = (scope, fingerprint, response_text)
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+def render_direct_quote(subject, body):
+    """Answer a structured quote request from the quote catalogue, or return None
+
+    Only emails whose extracted product codes are all in PRODUCT_PRICES, each
+    with exactly one quantity stated in an explicit quantity format (not a bare
+    number or the min-order fallback), are answered; anything else needs the model.
+    """
+    # 报价MCP服务器的产品识别和报价逻辑, 结构化的询价邮件可以直接在本地报价
+    from mcp_server.server import extract_product_info, generate_quote_by_product, PRODUCT_PRICES
+    
+    quantities = {}
+    for product in extract_product_info(body, subject):
+        if product["quantity_source"] != "explicit":
+            return None
+        quantities.setdefault(product["product_code"], set()).add(product["quantity"])
+    if not quantities or any(code not in PRODUCT_PRICES or len(qty) != 1 for code, qty in quantities.items()):
+        return None
+    
+    quotes = [orjson.loads(generate_quote_by_product(code, next(iter(qty)))) for code, qty in quantities.items()]
+    lines = [
+        "Dear Customer,",
+        "",
+        "Thank you for your inquiry. Please find our quotation below.",
+        "",
+    ]
+    currency = quotes[0]["currency"]
+    for quote in quotes:
+        item = quote["items"][0]
+        lines.append(
+            f"- {item['product_code']}: {item['quantity']:,} pcs x {quote['currency']} {item['discounted_price']:.4f}"
+            f" (list price {item['unit_price']:.4f}, discount {item['discount']})"
+            f" = {quote['currency']} {item['line_total']:,.2f}  [Quote {quote['quote_id']}]"
+        )
+    if all(quote["currency"] == currency for quote in quotes):
+        lines.append(f"\nTotal: {currency} {sum(quote['total_amount'] for quote in quotes):,.2f}")
+    lines += [
+        "",
+        f"This quotation is valid until {quotes[0]['valid_until']}. {quotes[0]['terms']}",
+        "",
+        "Please let us know if you would like to proceed or have any questions.",
+        "",
+        "Best regards,",
+        "LSCS Customer Service",
+    ]
+    return "\n".join(lines)
+
+async def generate_ai_response(subject, sender, body, model_name, model_id_map, use_cache=True,
+                               similarity_threshold=SIMILAR_RESPONSE_THRESHOLD, optimized_latency=False,
+                               max_tokens=AI_RESPONSE_MAX_TOKENS, direct_quotes=False):
+    """Generate an AI response for an email, yielding the text generated so far
+
+    With direct_quotes, emails that only ask for catalogue products are quoted
+    from the price list without calling the model. With use_cache, a reply
+    already generated for the same email (or, above similarity_threshold, a
+    reworded one with the same numbers from the same sender) with the same
+    model, max_tokens and system prompt is returned without calling the model again.
+    """
     try:
         logging.info(f"Generating AI response for email: {subject}")
-        client = CompatibleChatClientStream()
+        if direct_quotes and (quote_reply := render_direct_quote(subject, body)) is not None:
+            logging.info("Answered structured quote request without the model")
+            yield quote_reply
+            return
         
         model_id = model_id_map[model_name]
         logging.info(f"Using model: {model_name} ({model_id})")
         
-        system_prompt = """You are an advanced email customer service expert for LSCS, specializing in processing product inquiries and generating price quotes. Your primary functions include:
-
-1. Extracting product codes and quantities from customer emails
-2. Responding professionally to customer inquiries about product availability and pricing
-
-Respond to customers in a helpful, professional manner while ensuring all pricing information is accurate and clearly presented."""
+        cache_key = _response_cache_key(model_id, max_tokens, EMAIL_SYSTEM_PROMPT, subject, sender, body)
+        # 回复按发件人生成（称呼等），相似匹配只在同一发件人的邮件之间进行
+        cache_scope = _response_cache_key(model_id, max_tokens, EMAIL_SYSTEM_PROMPT, "", sender, "")
+        fingerprint = _email_fingerprint(subject, body)
+        if use_cache:
+            cached = _response_cache_get(cache_key)
+            if cached is None:
+                cached = _response_cache_find_similar(cache_scope, fingerprint, similarity_threshold)
+            if cached is not None:
+                logging.info(f"Using cached AI response ({len(cached)} chars)")
+                yield cached
+                return
         
+        client = _get_chat_client()
         message = f"Subject: {subject}\nFrom: {sender}\n\n{body}\n\nPlease generate a professional response to this email."
         
         response_text = ""
+        pending_chunks = 0
+        last_yield = time.monotonic()
+        # 流客户端把失败转成error/stopped事件后正常结束, 只有完整生成的回复才能缓存
+        stop_reason = None
+        failed = truncated = False
         
         messages = [{"role": "user", "content": message}]
-        system = [{"text": system_prompt}]
         
         logging.info("Starting AI response generation")
         # Generate response using process_query_stream
         async for event in client.process_query_stream(
             model_id=model_id,
-            max_tokens=2048,
+            max_tokens=int(max_tokens),
             temperature=0.7,
             messages=messages,
-            system=system
+            system=EMAIL_SYSTEM_BLOCKS,
+            extra_params={"optimized_latency": optimized_latency}
         ):
             if event["type"] == "block_delta" and "text" in event["data"]["delta"]:
                 response_text += event["data"]["delta"]["text"]
+                # 攒够一批片段或超过刷新间隔才更新UI
+                pending_chunks += 1
+                now = time.monotonic()
+                if pending_chunks >= STREAM_YIELD_CHUNKS or now - last_yield >= STREAM_YIELD_INTERVAL:
+                    pending_chunks, last_yield = 0, now
+                    yield response_text
+            elif event["type"] == "message_stop":
+                stop_reason = event["data"].get("stopReason")
+                # OpenAI兼容客户端在length之后还会再发一个end_turn
+                truncated = truncated or stop_reason in ("max_tokens", "length")
+            elif event["type"] in ("error", "stopped"):
+                failed = True
+                logging.warning(f"AI response generation interrupted: {event['data']}")
         
         logging.info(f"AI response generation complete ({len(response_text)} chars)")
-        return response_text
+        if response_text and stop_reason == "end_turn" and not (failed or truncated):
+            _response_cache_set(cache_key, cache_scope, fingerprint, response_text)
+        yield response_text
     except Exception as e:
         logging.exception(f"Error generating AI response: {str(e)}")
-        return f"Error generating response: {str(e)}"
+        yield f"Error generating response: {str(e)}"
+
+async def _final_ai_response(*args):
+    """Run generate_ai_response to completion and return the full reply"""
+    response_text = ""
+    async for response_text in generate_ai_response(*args):
+        pass
+    return response_text
+
+async def generate_ai_responses_ui(emails, selected_email_displays, model_name, model_id_map, use_cache,
+                                   similarity_threshold, optimized_latency, max_tokens, direct_quotes):
+    """Generate AI responses for all selected emails concurrently, returning (subject, response) rows"""
+    if not emails or not selected_email_displays:
+        return []
+    
+    emails_by_display = {f"[{email['date']}] {email['subject']} (From: {email['sender']})": email for email in emails}
+    selected_emails = [emails_by_display[display] for display in selected_email_displays if display in emails_by_display]
+    logging.info(f"Generating AI responses for {len(selected_emails)} emails")
+    # 限制同时进行的模型调用数量, 网络等待和模型生成仍然可以重叠
+    semaphore = asyncio.Semaphore(BATCH_RESPONSE_CONCURRENCY)
+    
+    async def respond(email):
+        async with semaphore:
+            body = email["body"]
+            if not body and "uid" in email:
+                source_account = _email_account(email)
+                body, error = (await asyncio.to_thread(fetch_body, source_account, email["uid"])
+                               if source_account else (None, "Account of this email is no longer configured"))
+                if error:
+                    return [email["subject"], f"Error loading email: {error}"]
+                email["body"] = body
+            response_text = await _final_ai_response(email["subject"], email["sender"], body, model_name, model_id_map,
+                                                     use_cache, similarity_threshold, optimized_latency, max_tokens,
+                                                     direct_quotes)
+            return [email["subject"], response_text]
+    
+    return await asyncio.gather(*(respond(email) for email in selected_emails))
 
 def create_ui():
     """Create Gradio UI"""
@@ -872,6 +1720,7 @@ def create_ui():
         
         # 初始化模型和服务器列表
         mcp_servers = gr.State({})
+        server_id_map = gr.State({})
         model_id_map = gr.State({})
         
         # 初始化邮箱和邮件列表
@@ -931,9 +1780,24 @@ def create_ui():
                     email_sender = gr.Textbox(label="From", interactive=False)
                     email_body = gr.Textbox(label="Body", lines=10, interactive=False)
                     
+                    with gr.Row():
+                        use_response_cache = gr.Checkbox(label="Reuse previous response for identical emails", value=True)
+                        similarity_threshold = gr.Slider(
+                            minimum=0.5, maximum=1.0, value=SIMILAR_RESPONSE_THRESHOLD, step=0.01,
+                            label="Similarity threshold for reworded emails"
+                        )
+                    with gr.Row():
+                        direct_quotes = gr.Checkbox(label="Quote catalogue products without the model", value=False)
+                        optimized_latency = gr.Checkbox(label="Optimized latency", value=False)
                     ai_response_btn = gr.Button("Generate AI Response", variant="primary", interactive=False)
                     
                     ai_response = gr.Textbox(label="AI Response", lines=10, interactive=False)
+                
+                # 批量生成回复
+                with gr.Accordion("## Batch Responses", open=False):
+                    email_multiselect = gr.CheckboxGroup(label="Select Emails", choices=[], interactive=True)
+                    ai_response_all_btn = gr.Button("Generate AI Responses for Selected", variant="primary")
+                    batch_responses = gr.Dataframe(headers=["Subject", "AI Response"], wrap=True, interactive=False)
             
             # 右侧面板 - 原有的MCP服务器管理
             with gr.Column(scale=1, elem_classes="sidebar"):
@@ -945,7 +1809,7 @@ def create_ui():
                 model_dropdown = gr.Dropdown(label="模型", interactive=True)
                 
                 max_tokens = gr.Slider(
-                    minimum=1, maximum=64000, value=8000, step=1000,
+                    minimum=64, maximum=64000, value=AI_RESPONSE_MAX_TOKENS, step=64,
                     label="最大输出token"
                 )
                 
@@ -966,12 +1830,7 @@ def create_ui():
                 
                 system_prompt = gr.Textbox(
                     label="System Prompt",
-                    value="""You are an advanced email customer service expert for LSCS, specializing in processing product inquiries and generating price quotes. Your primary functions include:
-
-1. Extracting product codes and quantities from customer emails
-2. Responding professionally to customer inquiries about product availability and pricing
-
-Respond to customers in a helpful, professional manner while ensuring all pricing information is accurate and clearly presented.""",
+                    value=EMAIL_SYSTEM_PROMPT,
                     lines=3
                 )
                 
@@ -994,19 +1853,23 @@ Respond to customers in a helpful, professional manner while ensuring all pricin
                             add_server_btn = gr.Button("添加服务器")
         
         # 页面加载时初始化数据
-        def init_data(request: gr.Request):
+        async def init_data(request: gr.Request):
             current_user_id = get_user_id(request)
-            mcp_servers_data, server_names = refresh_mcp_servers(current_user_id)
-            model_names, model_id_map_data = refresh_models(current_user_id)
+            # 并发获取服务器列表和模型列表, 页面加载只需等待较慢的那个请求
+            (mcp_servers_data, server_names, server_id_map_data), (model_names, model_id_map_data) = await asyncio.gather(
+                asyncio.to_thread(refresh_mcp_servers, current_user_id),
+                asyncio.to_thread(refresh_models, current_user_id)
+            )
             
             # 加载已有的邮箱账户
             accounts_data = load_email_accounts()
-            account_names = [account["username"] for account in accounts_data["accounts"]]
+            account_names = list(accounts_data["accounts_by_user"])
             current_account = accounts_data["current_account"]
             
             return (
                 current_user_id,
                 mcp_servers_data,
+                server_id_map_data,
                 model_id_map_data,
                 gr.update(choices=model_names, value=model_names[0] if model_names else None),
                 gr.update(choices=server_names),
@@ -1017,7 +1880,7 @@ Respond to customers in a helpful, professional manner while ensuring all pricin
         demo.load(
             init_data,
             inputs=[],
-            outputs=[user_id, mcp_servers, model_id_map, model_dropdown, server_checkboxes, account_dropdown, email_accounts]
+            outputs=[user_id, mcp_servers, server_id_map, model_id_map, model_dropdown, server_checkboxes, account_dropdown, email_accounts]
         )
         
         # 邮箱账户管理事件
@@ -1043,13 +1906,13 @@ Respond to customers in a helpful, professional manner while ensuring all pricin
         fetch_emails_btn.click(
             fetch_emails_ui,
             inputs=[email_accounts],
-            outputs=[email_username, email_subject, email_body, fetch_status, email_select, email_list]
+            outputs=[email_username, email_subject, email_body, fetch_status, email_select, email_list, email_multiselect]
         )
         
         refresh_btn.click(
             fetch_emails_ui,
             inputs=[email_accounts],
-            outputs=[email_username, email_subject, email_body, fetch_status, email_select, email_list]
+            outputs=[email_username, email_subject, email_body, fetch_status, email_select, email_list, email_multiselect]
         )
         
         # 选择邮件事件
@@ -1061,15 +1924,27 @@ Respond to customers in a helpful, professional manner while ensuring all pricin
         
         # AI生成回复事件
         ai_response_btn.click(
-            lambda subject, sender, body, model, model_id_map: asyncio.run(generate_ai_response(subject, sender, body, model, model_id_map)),
-            inputs=[email_subject, email_sender, email_body, model_dropdown, model_id_map],
-            outputs=[ai_response]
+            generate_ai_response,
+            inputs=[email_subject, email_sender, email_body, model_dropdown, model_id_map, use_response_cache, similarity_threshold,
+                    optimized_latency, max_tokens, direct_quotes],
+            outputs=[ai_response],
+            concurrency_limit=16
+        )
+        
+        # 批量生成回复事件
+        ai_response_all_btn.click(
+            generate_ai_responses_ui,
+            inputs=[email_list, email_multiselect, model_dropdown, model_id_map, use_response_cache, similarity_threshold,
+                    optimized_latency, max_tokens, direct_quotes],
+            outputs=[batch_responses],
+            concurrency_limit=4
         )
         
         # 刷新用户ID
         refresh_id_btn.click(
             generate_random_user_id,
-            outputs=[user_id_input]
+            outputs=[user_id_input],
+            concurrency_limit=4
         )
         
         # 保存用户ID
@@ -1089,14 +1964,18 @@ Respond to customers in a helpful, professional manner while ensuring all pricin
             outputs=[
                 new_server_name, new_server_id, new_server_cmd,
                 new_server_args, new_server_env, new_server_config,
-                add_server_status, mcp_servers, server_checkboxes
-            ]
+                add_server_status, mcp_servers, server_checkboxes, server_id_map
+            ],
+            concurrency_limit=4
         )
         
+    # 进程启动时即开始预取模型列表
+    start_catalog_warmer()
     return demo
 
 if __name__ == "__main__":
     port = int(os.environ.get("CHATBOT_SERVICE_PORT", 8502))
     demo = create_ui()
-    demo.queue()
+    # 默认并发上限用于普通事件, 耗时的AI生成事件单独设置更高的上限, 互不阻塞
+    demo.queue(default_concurrency_limit=8, max_size=128, api_open=False)
     demo.launch(server_name="0.0.0.0", server_port=port, share=False)
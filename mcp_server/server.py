@@ -1,21 +1,43 @@
 #!/usr/bin/env python3
 import json
 import re
+import time
+import zlib
+import bisect
 import logging
-from typing import Optional, Dict, Any, List
+import functools
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, NamedTuple
 from mcp.server.fastmcp import FastMCP, Context
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
+try:
+    # Much faster serializer for the quote JSON; optional since it is not a dependency of this server
+    import orjson
+except ImportError:
+    orjson = None
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging only when run as the MCP server; when imported (e.g. by mailagent
+# for direct quotes) the host application owns the logging setup
 logger = logging.getLogger("quote-server")
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+else:
+    logger.addHandler(logging.NullHandler())
 
 mcp = FastMCP("quote-server")
 
+def dumps_json(obj, indent: bool = False) -> str:
+    """Serialize a tool result to a JSON string, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(obj, indent=2 if indent else None)
+
+# The process timezone does not change, so probe it only once
+@functools.lru_cache(maxsize=1)
 def get_local_tz(local_tz_override: str | None = None) -> ZoneInfo:
     logger.info("Getting local timezone")
     
@@ -33,6 +55,7 @@ def get_local_tz(local_tz_override: str | None = None) -> ZoneInfo:
         raise ValueError('get local timezone failed')
         
 
+@functools.lru_cache(maxsize=32)
 def get_zoneinfo(timezone_name: str) -> ZoneInfo:
     logger.info(f"Getting ZoneInfo for timezone: {timezone_name}")
     try:
@@ -55,23 +78,135 @@ def update_docstring_with_info(func):
         logger.info(f"Docstring updated with local timezone: {local_tz}")
     return func
 
-# Product price database (for demo purposes)
-PRODUCT_PRICES = {
+class PriceInfo(NamedTuple):
+    """Catalog entry for a product"""
+    unit_price: float
+    currency: str
+    min_order: int
+
+# Product price database (for demo purposes), read-only
+PRODUCT_PRICES = MappingProxyType({
     # Original products with dashed format
-    "08-50-0113": {"unit_price": 1.25, "currency": "USD", "min_order": 1000},
-    "22-01-1042": {"unit_price": 3.75, "currency": "USD", "min_order": 500},
-    "42816-0212": {"unit_price": 15.50, "currency": "USD", "min_order": 100},
+    "08-50-0113": PriceInfo(1.25, "USD", 1000),
+    "22-01-1042": PriceInfo(3.75, "USD", 500),
+    "42816-0212": PriceInfo(15.50, "USD", 100),
     
     # Add new product formats from emails
-    "STM32G030K8T6": {"unit_price": 2.35, "currency": "USD", "min_order": 1000},
-    "RY8601AT6": {"unit_price": 0.85, "currency": "USD", "min_order": 500},
+    "STM32G030K8T6": PriceInfo(2.35, "USD", 1000),
+    "RY8601AT6": PriceInfo(0.85, "USD", 500),
     
     # Add capacitor products from email5
-    "CC0402KRX7R9BB102": {"unit_price": 0.08, "currency": "USD", "min_order": 100},
-    "CL05B102KB5NNNC": {"unit_price": 0.07, "currency": "USD", "min_order": 100},
-    "CC0603KRX7R9BB473": {"unit_price": 0.10, "currency": "USD", "min_order": 100},
-    "CL10B473KB8NNNC": {"unit_price": 0.09, "currency": "USD", "min_order": 100},
-}
+    "CC0402KRX7R9BB102": PriceInfo(0.08, "USD", 100),
+    "CL05B102KB5NNNC": PriceInfo(0.07, "USD", 100),
+    "CC0603KRX7R9BB473": PriceInfo(0.10, "USD", 100),
+    "CL10B473KB8NNNC": PriceInfo(0.09, "USD", 100),
+})
+
+def regex_opt(words) -> str:
+    """Build a regex matching exactly the given words, with common prefixes factored out"""
+    words = sorted(set(words))
+    if len(words) == 1:
+        return re.escape(words[0])
+    if '' in words:
+        return '(?:' + regex_opt([w for w in words if w]) + ')?'
+    groups = {}
+    for word in words:
+        groups.setdefault(word[0], []).append(word)
+    branches = []
+    for first, group in groups.items():
+        if len(group) == 1:
+            branches.append(re.escape(group[0]))
+            continue
+        # 取组内最长公共前缀，剩余部分递归处理
+        prefix = first
+        while all(len(w) > len(prefix) and w[len(prefix)] == group[0][len(prefix)] for w in group):
+            prefix += group[0][len(prefix)]
+        branches.append(re.escape(prefix) + regex_opt([w[len(prefix):] for w in group]))
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+# Discount by tier: below 2x, 2x, 5x and 10x the product's min order
+DISCOUNT_TIER_MULTIPLES = (2, 5, 10)
+DISCOUNT_TIERS = (0, 0.05, 0.10, 0.15)
+
+@functools.lru_cache(maxsize=None)
+def get_discount_thresholds(min_order: int) -> tuple:
+    """Sorted quantities at which each discount tier starts for a given min order"""
+    return tuple(min_order * multiple for multiple in DISCOUNT_TIER_MULTIPLES)
+
+# Quotes issued within the same second share their formatted dates
+@functools.lru_cache(maxsize=4)
+def get_quote_dates(timestamp: int) -> tuple:
+    """Quote date, validity end date (30 days later) and compact quote ID date for a Unix timestamp"""
+    quote_date = datetime.fromtimestamp(timestamp)
+    valid_until = quote_date + timedelta(days=30)
+    return quote_date.strftime("%Y-%m-%d"), valid_until.strftime("%Y-%m-%d"), quote_date.strftime("%Y%m%d")
+
+# Product code patterns, tried in this order at each position. Open-ended quantifiers that
+# can backtrack over a long run of digits are bounded or anchored at the start of the run,
+# so a pathological email is scanned in linear rather than quadratic time
+PRODUCT_CODE_PATTERNS = [
+    # Pattern 0: Codes from the catalog, matched exactly when not followed by more code characters
+    r'(' + regex_opt(PRODUCT_PRICES) + r')(?![A-Z0-9-])',
+    # Pattern 1: Standard format with dashes like 08-50-0113, 42816-0212
+    r'(?<!\d)(\d+(?:-\d+)+)',
+    # Pattern 2: General alphanumeric product codes (most flexible)
+    r'([A-Z]{2}[0-9]{2,6}[A-Z]+[0-9A-Z]*)',
+    # Pattern 3: Specific format for microcontrollers like STM32G030K8T6
+    r'([A-Z0-9]{5,32}[A-Z][0-9A-Z]{3,32})',
+    # Pattern 4: Codes with mixed characters like CC0402KRX7R9BB102
+    r'([A-Z]{2}[0-9]{4,}[A-Z0-9]{5,})',
+    # Pattern 5: Simple pattern for codes in "LETTERSNUMBERS" format
+    r'\b([A-Z]{2,}[0-9]{2,}[A-Z0-9]*)\b',
+]
+# One alternation scans the email once instead of once per pattern; matches don't overlap,
+# so the tail of a longer code (TM32G030K8T6 inside STM32G030K8T6) is no longer reported as a code
+PRODUCT_CODE_RE = re.compile('|'.join(PRODUCT_CODE_PATTERNS))
+
+# Quantity patterns as (literals, pattern, extract function), most specific format first;
+# a pattern can only match text containing one of its literals, so a cheap substring check
+# skips most regex scans
+QUANTITY_PATTERNS = [
+    # Format 1: for 1000 and 5000 pcs
+    (('pcs',), re.compile(r'for\s+(\d+)\s+and\s+(\d+)\s+pcs'), lambda m: [int(m.group(1)), int(m.group(2))]),
+    # Format 2: for 10000 pcs
+    (('pcs',), re.compile(r'for\s+(\d+)\s+pcs'), lambda m: int(m.group(1))),
+    # Format 3: 20Kpcs, 5Kpcs, 200pcs
+    (('pcs',), re.compile(r'(?<!\d)(\d+)([Kk]?)pcs'), lambda m: int(m.group(1)) * (1000 if m.group(2).lower() == 'k' else 1)),
+    # Format 4: 10000 pieces, one shot collection for 10000 pieces
+    (('pieces',), re.compile(r'(?<!\d)(\d+)\s*pieces'), lambda m: int(m.group(1))),
+    # Format 5: one shot collection for 10000
+    (('shot', 'collection'), re.compile(r'(?:one\s+shot|collection)\s+(?:for\s+)?(\d+)'), lambda m: int(m.group(1))),
+    # Format 6: Just numbers with K suffix
+    (('K', 'k'), re.compile(r'(?<!\d)(\d+)[Kk]'), lambda m: int(m.group(1)) * 1000)
+]
+
+def find_quantities(text: str, start: int = 0, end: Optional[int] = None, exclude=()) -> List[int]:
+    """Quantities in text[start:end] from the most specific quantity format that matches,
+    ignoring matches that overlap any (start, end) span in exclude"""
+    if end is None:
+        end = len(text)
+    for literals, pattern, extract_func in QUANTITY_PATTERNS:
+        if not any(text.find(literal, start, end) >= 0 for literal in literals):
+            continue
+        quantities = []
+        for qty_match in pattern.finditer(text, start, end):
+            # 产品代码内部的字符（如 STM32G030K8T6 中的 030K）不是数量
+            if exclude and any(s < qty_match.end() and qty_match.start() < e for s, e in exclude):
+                continue
+            qty_result = extract_func(qty_match)
+            if isinstance(qty_result, list):
+                quantities.extend(qty_result)
+            else:
+                quantities.append(qty_result)
+        # 只采用第一个命中的格式，避免同一数量被多个格式重复提取（如 5Kpcs）
+        if quantities:
+            return quantities
+    return []
+
+# Numbers of 3+ digits that are not part of a product code
+STANDALONE_NUMBER_RE = re.compile(r'(?<![A-Za-z0-9-])(\d{3,})(?![A-Za-z0-9-])')
 
 def extract_product_info(email_content: str, subject: str = "") -> List[Dict[str, Any]]:
     """
@@ -82,119 +217,85 @@ def extract_product_info(email_content: str, subject: str = "") -> List[Dict[str
         subject: The subject of the email (optional)
         
     Returns:
-        List of dictionaries containing product code and quantity
+        List of dictionaries containing product code, quantity and where the quantity
+        came from: "explicit" (a quantity format such as 5Kpcs), "standalone" (a
+        bare number near the code), "min_order" or "default" (nothing found)
     """
     logger.info("Extracting product information from email content")
     products = []
     combined_text = subject + "\n" + email_content
     
     # Extract product codes - multiple formats
-    # Look for different product code patterns
-    product_code_patterns = [
-        # Pattern 1: Standard format with dashes like 08-50-0113, 42816-0212
-        r'(\d+(?:-\d+)+)',
-        # Pattern 2: General alphanumeric product codes (most flexible)
-        r'([A-Z]{2}[0-9]{2,6}[A-Z]+[0-9A-Z]*)',
-        # Pattern 3: Specific format for microcontrollers like STM32G030K8T6
-        r'([A-Z0-9]{5,}[A-Z][0-9A-Z]{3,})',
-        # Pattern 4: Codes with mixed characters like CC0402KRX7R9BB102
-        r'([A-Z]{2}[0-9]{4,}[A-Z0-9]{5,})', 
-        # Pattern 5: Simple pattern for codes in "LETTERSNUMBERS" format
-        r'\b([A-Z]{2,}[0-9]{2,}[A-Z0-9]*)\b'
-    ]
-    
     # First, find all possible product codes
-    product_codes = set()
-    for pattern in product_code_patterns:
-        matches = re.finditer(pattern, combined_text)
-        for match in matches:
-            code = match.group(1)
-            # Skip common words/numbers that might be incorrectly matched
-            if len(code) >= 6 and not code.lower() in ['pieces', 'thank', 'today']:
-                product_codes.add(code)
-    
-    logger.info(f"Found potential product codes: {product_codes}")
+    # Remember where each code first appears so quantities can be searched around it
+    product_code_positions: Dict[str, int] = {}
+    # Spans of every code occurrence, so quantity formats are never read from inside a code
+    code_spans = []
+    for match in PRODUCT_CODE_RE.finditer(combined_text):
+        # Each pattern has a single group, so the last matched group is the code
+        code = match.group(match.lastindex)
+        # Skip common words/numbers that might be incorrectly matched
+        if len(code) >= 6 and not code.lower() in ['pieces', 'thank', 'today']:
+            product_code_positions.setdefault(code, match.start(match.lastindex))
+            code_spans.append(match.span(match.lastindex))
+    
+    logger.info("Found potential product codes: %s", list(product_code_positions))
     
     # Now extract quantities - multiple formats
-    quantity_patterns = [
-        # Format 1: 20Kpcs, 5Kpcs, 200pcs
-        (r'(\d+)([Kk]?)pcs', lambda m: int(m.group(1)) * (1000 if m.group(2).lower() == 'k' else 1)),
-        # Format 2: 10000 pieces, one shot collection for 10000 pieces
-        (r'(\d+)\s*pieces', lambda m: int(m.group(1))),
-        # Format 3: for 1000 and 5000 pcs
-        (r'for\s+(\d+)\s+and\s+(\d+)\s+pcs', lambda m: [int(m.group(1)), int(m.group(2))]),
-        # Format 4: for 10000 pcs
-        (r'for\s+(\d+)\s+pcs', lambda m: int(m.group(1))),
-        # Format 5: one shot collection for 10000
-        (r'(?:one\s+shot|collection)\s+(?:for\s+)?(\d+)', lambda m: int(m.group(1))),
-        # Format 6: Just numbers with K suffix
-        (r'(\d+)[Kk]', lambda m: int(m.group(1)) * 1000)
-    ]
-    
     # For each product code, try to find associated quantities
-    for code in product_codes:
-        quantities = []
+    for code, code_pos in product_code_positions.items():
         # Check if any quantity patterns appear near this code (within 100 chars)
-        code_pos = combined_text.find(code)
-        if code_pos >= 0:
-            search_area = combined_text[max(0, code_pos - 50):min(len(combined_text), code_pos + 100)]
-            
-            for pattern, extract_func in quantity_patterns:
-                qty_matches = re.finditer(pattern, search_area)
-                for qty_match in qty_matches:
-                    qty_result = extract_func(qty_match)
-                    if isinstance(qty_result, list):
-                        quantities.extend(qty_result)
-                    else:
-                        quantities.append(qty_result)
+        # The window is scanned in place through pos/endpos rather than sliced out
+        area_start = max(0, code_pos - 50)
+        area_end = min(len(combined_text), code_pos + 100)
+        quantities = find_quantities(combined_text, area_start, area_end, code_spans)
         
         # If no quantity found but code is in subject, check for quantities in body
         if not quantities and subject and code in subject:
-            for pattern, extract_func in quantity_patterns:
-                qty_matches = re.finditer(pattern, email_content)
-                for qty_match in qty_matches:
-                    qty_result = extract_func(qty_match)
-                    if isinstance(qty_result, list):
-                        quantities.extend(qty_result)
-                    else:
-                        quantities.append(qty_result)
+            quantities = find_quantities(combined_text, len(subject) + 1, len(combined_text), code_spans)
+        quantity_source = "explicit"
         
         # Look for standalone numbers near products when no quantity formats match
-        if not quantities and code_pos >= 0:
-            search_area = combined_text[max(0, code_pos - 50):min(len(combined_text), code_pos + 100)]
-            standalone_numbers = re.findall(r'(?<![A-Za-z0-9-])(\d{3,})(?![A-Za-z0-9-])', search_area)
+        if not quantities:
+            quantity_source = "standalone"
+            standalone_numbers = STANDALONE_NUMBER_RE.finditer(combined_text, area_start, area_end)
             
-            for num_str in standalone_numbers:
+            for num_match in standalone_numbers:
                 try:
-                    num = int(num_str)
+                    num = int(num_match.group(1))
                     # Only consider reasonable quantities (between 10 and 1,000,000)
                     if 10 <= num <= 1000000:
                         quantities.append(num)
-                        logger.info(f"Found standalone quantity for {code}: {num}")
+                        logger.info("Found standalone quantity for %s: %s", code, num)
                 except ValueError:
                     continue
         
         # Default quantity if still none found
         if not quantities:
             # Use min order from product database if product exists there
-            if code in PRODUCT_PRICES:
-                default_qty = PRODUCT_PRICES[code]["min_order"]
-                logger.info(f"No quantity found for product: {code}, using min order: {default_qty}")
+            price_info = PRODUCT_PRICES.get(code)
+            quantity_source = "min_order" if price_info is not None else "default"
+            if price_info is not None:
+                default_qty = price_info.min_order
+                logger.info("No quantity found for product: %s, using min order: %s", code, default_qty)
                 quantities = [default_qty]
             else:
                 # Use general default for unknown products
-                logger.info(f"No quantity found for product: {code}, using default of 1000")
+                logger.info("No quantity found for product: %s, using default of 1000", code)
                 quantities = [1000]
         
         # Create product entries for each quantity
         for qty in quantities:
             products.append({
                 "product_code": code,
-                "quantity": qty
+                "quantity": qty,
+                "quantity_source": quantity_source
             })
-            logger.info(f"Found product: {code}, quantity: {qty}")
+        if logger.isEnabledFor(logging.INFO):
+            for qty in quantities:
+                logger.info("Found product: %s, quantity: %s", code, qty)
     
-    logger.info(f"Extracted {len(products)} product-quantity combinations from email")
+    logger.info("Extracted %d product-quantity combinations from email", len(products))
     return products
 
 # @mcp.tool()
@@ -251,11 +352,9 @@ def extract_product_info(email_content: str, subject: str = "") -> List[Dict[str
 #         product_code = product["product_code"]
 #         quantity = product["quantity"]
         
-#         if product_code in PRODUCT_PRICES:
-#             price_info = PRODUCT_PRICES[product_code]
-#             unit_price = price_info["unit_price"]
-#             currency = price_info["currency"]
-#             min_order = price_info["min_order"]
+#         price_info = PRODUCT_PRICES.get(product_code)
+#         if price_info is not None:
+#             unit_price, currency, min_order = price_info
             
 #             # Apply discount for larger quantities
 #             if quantity >= min_order * 10:
@@ -334,25 +433,18 @@ def generate_quote_by_product(product_code: str, quantity: int, brand: str="") -
     currency = "USD"  # Default currency
     
     # Check if product exists in our database
-    if product_code in PRODUCT_PRICES:
-        price_info = PRODUCT_PRICES[product_code]
-        unit_price = price_info["unit_price"]
-        currency = price_info["currency"]
-        min_order = price_info["min_order"]
+    price_info = PRODUCT_PRICES.get(product_code)
+    if price_info is not None:
+        unit_price, currency, min_order = price_info
         
-        # Apply discount for larger quantities
-        if quantity >= min_order * 10:
-            discount = 0.15  # 15% discount
-            logger.info(f"Applied 15% discount for product {product_code} (quantity: {quantity})")
-        elif quantity >= min_order * 5:
-            discount = 0.10  # 10% discount
-            logger.info(f"Applied 10% discount for product {product_code} (quantity: {quantity})")
-        elif quantity >= min_order * 2:
-            discount = 0.05  # 5% discount
-            logger.info(f"Applied 5% discount for product {product_code} (quantity: {quantity})")
-        else:
-            discount = 0
-            logger.info(f"No discount applied for product {product_code} (quantity: {quantity})")
+        # Apply discount for larger quantities: the tier is the number of thresholds reached
+        tier = bisect.bisect_right(get_discount_thresholds(min_order), quantity)
+        discount = DISCOUNT_TIERS[tier]
+        if logger.isEnabledFor(logging.INFO):
+            if discount:
+                logger.info("Applied %.0f%% discount for product %s (quantity: %s)", discount * 100, product_code, quantity)
+            else:
+                logger.info("No discount applied for product %s (quantity: %s)", product_code, quantity)
             
         discounted_price = unit_price * (1 - discount)
         line_total = discounted_price * quantity
@@ -369,23 +461,23 @@ def generate_quote_by_product(product_code: str, quantity: int, brand: str="") -
         })
     else:
         logger.warning(f"Product not found in catalog: {product_code}")
-        return json.dumps({
+        return dumps_json({
             "error": f"Product {product_code} not found in catalog",
             "quote": None
         })
     
     # Generate quote with unique ID and validity period
-    quote_date = datetime.now()
-    valid_until = quote_date + timedelta(days=30)
+    quote_date, valid_until, quote_day = get_quote_dates(int(time.time()))
     
     # Generate a unique quote ID based on product code, brand, and quantity
-    quote_id = f"Q-{quote_date.strftime('%Y%m%d')}-{hash(f'{product_code}{brand}{quantity}') % 10000:04d}"
+    # crc32 is stable across restarts, unlike the per-process salted hash()
+    quote_id = f"Q-{quote_day}-{zlib.crc32(f'{product_code}{brand}{quantity}'.encode()) % 10000:04d}"
     logger.info(f"Generated quote ID: {quote_id}")
     
     quote = {
         "quote_id": quote_id,
-        "date": quote_date.strftime("%Y-%m-%d"),
-        "valid_until": valid_until.strftime("%Y-%m-%d"),
+        "date": quote_date,
+        "valid_until": valid_until,
         "currency": currency,
         "items": quote_items,
         "total_amount": total_amount,
@@ -393,7 +485,7 @@ def generate_quote_by_product(product_code: str, quantity: int, brand: str="") -
     }
     
     logger.info(f"Quote generated successfully for product {product_code}, total amount: {total_amount} {currency}")
-    return json.dumps(quote, indent=2)
+    return dumps_json(quote, indent=True)
     
     
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import os
 import sys
 import asyncio
 import logging
+import threading
 from typing import Dict,AsyncGenerator
 import boto3
 from botocore.config import Config
@@ -24,6 +25,40 @@ logger = logging.getLogger(__name__)
 
 CLAUDE_37_SONNET_MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
 
+# Bedrock clients are thread-safe, so one client per credential set is shared by every session;
+# this avoids the client construction cost per query and lets connections be reused across users
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get('BEDROCK_MAX_POOL_CONNECTIONS', 50))
+_bedrock_clients = {}
+_bedrock_clients_lock = threading.Lock()
+
+def get_shared_bedrock_client(access_key_id=None, secret_access_key=None, region=None, runtime=True):
+    """Get the process-wide Bedrock client for a credential set, creating it on first use"""
+    key = (access_key_id, secret_access_key, region, runtime)
+    with _bedrock_clients_lock:
+        bedrock_client = _bedrock_clients.get(key)
+        if bedrock_client is None:
+            client_kwargs = dict(
+                service_name='bedrock-runtime' if runtime else 'bedrock',
+                config=Config(
+                    retries={
+                        "max_attempts": 3,
+                        "mode": "standard",
+                    },
+                    read_timeout=600,
+                    max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                )
+            )
+            if access_key_id and secret_access_key:
+                client_kwargs.update(
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    region_name=region,
+                )
+            bedrock_client = boto3.client(**client_kwargs)
+            _bedrock_clients[key] = bedrock_client
+    return bedrock_client
+
 class ChatClient:
     """Bedrock simple chat wrapper"""
 
@@ -40,7 +75,8 @@ class ChatClient:
         self.messages = [] # History messages without system message
         self.system = None
         
-        if credential_file:
+        # The pool is shared by all instances, so load it only once per process
+        if credential_file and not self.bedrock_client_pool:
             credentials = pd.read_csv(credential_file)
             for index, row in credentials.iterrows():
                 self.bedrock_client_pool.append(self._get_bedrock_client(ak=row['ak'],sk=row['sk']))
@@ -48,45 +84,12 @@ class ChatClient:
 
     def _get_bedrock_client(self, ak='', sk='', region='', runtime=True):
         if ak and sk:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=ak,
-                aws_secret_access_key=sk,
-                region_name=region or os.environ.get('AWS_REGION'),
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                )
-            )
-        if self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'],
-                region_name=self.env['AWS_REGION'],
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                )
-            )
+            credentials = (ak, sk, region or os.environ.get('AWS_REGION'))
+        elif self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
+            credentials = (self.env['AWS_ACCESS_KEY_ID'], self.env['AWS_SECRET_ACCESS_KEY'], self.env['AWS_REGION'])
         else:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                ))
-
-        return bedrock_client
+            credentials = (None, None, None)
+        return get_shared_bedrock_client(*credentials, runtime=runtime)
     
     def clear_history(self):
         """clear session message of this client"""
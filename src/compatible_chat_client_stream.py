@@ -7,7 +7,6 @@ import sys
 import asyncio
 import logging
 import json
-import time
 import random
 import base64
 from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator, Any, override
@@ -16,7 +15,7 @@ from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 import requests
-from openai import OpenAI
+from openai import AsyncOpenAI
 from chat_client_stream import ChatClientStream
 from chat_client import ChatClient
 
@@ -43,12 +42,13 @@ class CompatibleChatClientStream(ChatClient):
         self.max_delay = 60  # Maximum backoff delay in seconds
         self.client_index = 0
         self.stop_flags = {}  # Dict to track stop flags for streams
-        # Initialize the OpenAI client
+        # Initialize the OpenAI client; the async client streams without blocking the event loop
+        # and keeps its connection pool for the lifetime of this instance
         
-        self.openai_client = OpenAI(
+        self.openai_client = AsyncOpenAI(
             api_key=self.api_key,
             base_url=self.api_base
-        ) if self.api_base else OpenAI(
+        ) if self.api_base else AsyncOpenAI(
             api_key=self.api_key
         )
         
@@ -79,13 +79,8 @@ class CompatibleChatClientStream(ChatClient):
         try:
             # For SDK streamed responses, we iterate through the chunks
             tool_index=0
-            last_yield_time = time.time()
-            for chunk in stream_response:
-                current_time = time.time()
-                if current_time - last_yield_time > 0.1:  # 每100ms让出一次控制权，避免阻塞
-                    await asyncio.sleep(0.001)
-                    last_yield_time = current_time
-                
+            # 异步流读取每个chunk时都会让出控制权, 不需要额外sleep
+            async for chunk in stream_response:
                 if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
                     logger.info(f"Stream {stream_id} was requested to stop")
                     yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
@@ -191,17 +186,25 @@ class CompatibleChatClientStream(ChatClient):
             logger.error(f"Error processing OpenAI stream response: {e}")
             yield {"type": "error", "data": {"error": str(e)}}
     
-    def _convert_messages_to_openai_format(self, messages, system=None):
+    def _convert_messages_to_openai_format(self, messages, system=None, prompt_cache=False):
         """Convert Bedrock message format to OpenAI format"""
         openai_messages = []
         
         # Add system message if provided
         if system:
             system_text = ""
+            cache_system = False
             for item in system:
                 if isinstance(item, dict) and "text" in item:
                     system_text += item["text"]
-            if system_text:
+                elif isinstance(item, dict) and "cachePoint" in item:
+                    cache_system = prompt_cache
+            if system_text and cache_system:
+                # Bedrock的cachePoint对应Anthropic兼容接口中文本块上的cache_control
+                openai_messages.append({"role": "system", "content": [
+                    {"type": "text", "text": system_text, "cache_control": {"type": "ephemeral"}}
+                ]})
+            elif system_text:
                 openai_messages.append({"role": "system", "content": system_text})
         
         # Process other messages
@@ -343,8 +346,9 @@ class CompatibleChatClientStream(ChatClient):
         if stream_id:
             self.register_stream(stream_id)
         
-        # Convert Bedrock format to OpenAI format
-        openai_messages = self._convert_messages_to_openai_format(messages, system)
+        # Convert Bedrock format to OpenAI format; only Claude models accept cache_control blocks
+        prompt_cache = 'claude' in model_id.lower()
+        openai_messages = self._convert_messages_to_openai_format(messages, system, prompt_cache)
         openai_tools = self._convert_tools_config(tool_config)
         
         # Convert Bedrock request parameters to OpenAI parameters
@@ -367,6 +371,9 @@ class CompatibleChatClientStream(ChatClient):
                 request_payload["top_p"] = extra_params["top_p"]
             if "top_k" in extra_params:
                 request_payload["top_logprobs"] = extra_params["top_k"]  # Not exact equivalent, but similar concept
+            if extra_params.get("optimized_latency"):
+                # Passed through to Bedrock-backed gateways as the Converse performanceConfig
+                request_payload["extra_body"] = {"performanceConfig": {"latency": "optimized"}}
         
         current_content = ""
         thinking_text = ""
@@ -390,7 +397,7 @@ class CompatibleChatClientStream(ChatClient):
                 
             try:
                 # Make the API request using the OpenAI SDK directly
-                response = self.openai_client.chat.completions.create(**request_payload)
+                response = await self.openai_client.chat.completions.create(**request_payload)
                 
                 # Process the streaming response
                 async for event in self._process_openai_stream_response(stream_id,response):
@@ -541,7 +548,7 @@ class CompatibleChatClientStream(ChatClient):
                             
                             # logger.info(f"before convert:{messages}")
                             # Update OpenAI messages format for the next request
-                            openai_messages = self._convert_messages_to_openai_format(messages, system)
+                            openai_messages = self._convert_messages_to_openai_format(messages, system, prompt_cache)
                             request_payload["messages"] = openai_messages
                             # logger.info(openai_messages)
                             
@@ -119,21 +119,20 @@ async def initialize_user_servers(session: UserSession):
     server_configs = {**server_configs, **global_server_configs}
     
     logger.info(f"server_configs:{server_configs}")
-    # 初始化服务器连接
-    for server_id, config in server_configs.items():
-        if server_id in session.mcp_clients:  # 跳过已存在的服务器
-            continue
-            
+    # 初始化服务器连接，跳过已存在的服务器，其余并发连接
+    pending = {server_id: config for server_id, config in server_configs.items()
+               if server_id not in session.mcp_clients}
+    clients = await MCPClient.connect_many([{
+        "name": f"{session.user_id}_{server_id}",
+        "command": config.get('command'),
+        "server_url": config.get('url'),
+        "server_script_args": config.get("args", []),
+        "server_script_envs": config.get("env", {}),
+    } for server_id, config in pending.items()])
+    for (server_id, config), mcp_client in zip(pending.items(), clients):
         try:
-            # 创建并连接MCP服务器
-            mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
-            await mcp_client.connect_to_server(
-                command=config.get('command'),
-                server_url=config.get('url'),
-                server_script_args=config.get("args", []),
-                server_script_envs=config.get("env", {})
-            )
-            
+            if isinstance(mcp_client, BaseException):
+                raise mcp_client
             # 添加到用户的客户端列表
             session.mcp_clients[server_id] = mcp_client
             await save_user_server_config(user_id, server_id, config)
@@ -6,14 +6,20 @@ SPDX-License-Identifier: MIT-0
 MCP Client maintains Multi-MCP-Servers
 """
 import os
+import time
 import logging
 import asyncio
+import json
+import inspect
+import functools
+import httpx
 from typing import Optional, Dict
+from collections import OrderedDict
 from contextlib import AsyncExitStack
 from pydantic import ValidationError
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client, get_default_environment
-from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource,CallToolResult,NotificationParams
+from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource,CallToolResult,NotificationParams,ServerNotification,ToolListChangedNotification
 from mcp.shared.exceptions import McpError
 from dotenv import load_dotenv
 from mcp.client.sse import sse_client
@@ -26,8 +32,68 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 delimiter = "___"
-tool_name_mapping = {}
-tool_name_mapping_r = {}
+# Characters not allowed in LLM tool names, all replaced by '_'
+TOOL_NAME_TRANSLATION = str.maketrans('-/:', '___')
+# Idle seconds after which a session is pinged before being reused
+SESSION_TTL = int(os.environ.get('MCP_SESSION_TTL', 300))
+# Seconds to wait for that ping and for a reconnect after it fails
+SESSION_PING_TIMEOUT = float(os.environ.get('MCP_SESSION_PING_TIMEOUT', 5))
+SESSION_RECONNECT_TIMEOUT = float(os.environ.get('MCP_SESSION_RECONNECT_TIMEOUT', 30))
+# Results of tools annotated readOnlyHint and idempotentHint (or listed in MCP_CACHEABLE_TOOLS)
+# are memoized per client for a short time, keyed by tool name and arguments
+TOOL_RESULT_CACHE_SIZE = int(os.environ.get('MCP_TOOL_RESULT_CACHE_SIZE', 512))
+TOOL_RESULT_CACHE_TTL = float(os.environ.get('MCP_TOOL_RESULT_CACHE_TTL', 30))
+CACHEABLE_TOOLS = frozenset(name.strip() for name in os.environ.get('MCP_CACHEABLE_TOOLS', '').split(',') if name.strip())
+# Command to run a server script with, by 'prefix:' of a package or by file extension
+SCRIPT_PREFIX_COMMANDS = {'uv': 'uv', 'uvx': 'uvx', 'npx': 'npx', 'docker': 'docker'}
+SCRIPT_EXT_COMMANDS = {'.py': 'python', '.js': 'node'}
+# Connection pool for the SSE transport's HTTP client, on mcp versions that let us supply it
+SSE_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30.0)
+SSE_ACCEPTS_CLIENT_FACTORY = 'httpx_client_factory' in inspect.signature(sse_client).parameters
+# Attempts and backoff (seconds) for starting a transport that fails with a transient I/O error
+CONNECT_ATTEMPTS = 3
+CONNECT_BASE_DELAY = 0.1
+CONNECT_MAX_DELAY = 2.0
+# Seconds cleanup waits for a session task to close its transport before cancelling it
+SESSION_CLOSE_TIMEOUT = 10.0
+LIST_TOOLS_ACCEPTS_CURSOR = 'cursor' in inspect.signature(ClientSession.list_tools).parameters
+
+def sse_http_client(headers=None, timeout=None, auth=None):
+    """httpx client factory for sse_client, one client is kept for the whole session"""
+    return httpx.AsyncClient(headers=headers, timeout=timeout, auth=auth,
+                             follow_redirects=True, limits=SSE_HTTP_LIMITS)
+
+class MCPRegistry:
+    """Mapping between MCP tool keys (server_id + delimiter + tool name) and LLM tool names.
+
+    Entries are a pure function of their key and never overwritten once written,
+    so concurrent registration from several tasks or threads needs no lock.
+    """
+
+    def __init__(self):
+        self.tool_name_mapping = {}
+        self.tool_name_mapping_r = {}
+        # (LLM tool name, delimiter) -> (server_id, tool name), only for names that parsed
+        self.split_cache = {}
+
+    def register(self, tool_key, tool_name4llm):
+        """Record a mapping, returns True if it was not known yet"""
+        if self.tool_name_mapping_r.get(tool_name4llm) == tool_key:
+            return False
+        self.tool_name_mapping.setdefault(tool_key, tool_name4llm)
+        self.tool_name_mapping_r.setdefault(tool_name4llm, tool_key)
+        return True
+
+    def lookup(self, tool_name4llm):
+        """Get the MCP tool key of an LLM tool name, empty if unknown"""
+        return self.tool_name_mapping_r.get(tool_name4llm, "")
+
+    def reset(self):
+        self.tool_name_mapping.clear()
+        self.tool_name_mapping_r.clear()
+        self.split_cache.clear()
+
+registry = MCPRegistry()
 class MCPClient:
     """Manage MCP sessions.
 
@@ -44,38 +110,65 @@ class MCPClient:
             'AWS_REGION': region or os.environ.get('AWS_REGION'),
         }
         self.name = name
+        # Environment for stdio servers, built once and reused by every (re)connect
+        self._base_env = get_default_environment()
+        if self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
+            self._base_env.update(self.env)
+            logger.info(f"Using AWS credentials for region: {self.env['AWS_REGION']}")
         # self.sessions: Dict[str, Optional[ClientSession]] = {}
         self.session = None
         self.exit_stack = AsyncExitStack()
+        # Bedrock tool configs built from list_tools, keyed by server_id; dropped on reconnect or tools/list_changed
+        self._tool_config_cache: Dict[str, Dict] = {}
+        # Tools listed on connect, reused by the first get_tool_config
+        self._tools: Optional[list] = None
+        # Arguments of the last successful connect_to_server, used to reconnect a dead session
+        self._connect_params: Optional[Dict] = None
+        self._last_used = 0.0
+        # Health check / reconnect shared by concurrent callers
+        self._health_task: Optional[asyncio.Task] = None
+        # Long-lived task that enters, holds and exits the transport/session contexts,
+        # and the event that tells it to close them
+        self._session_task: Optional[asyncio.Task] = None
+        self._session_stop: Optional[asyncio.Event] = None
+        self._result_cache: OrderedDict = OrderedDict()
+        self._cacheable_tools: set = set()
+        # Bumped on every clear, so a call that was in flight during a clear does not store its result
+        self._cache_generation = 0
 
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def normalize_tool_name(tool_name):
-        normalized = tool_name.replace('-', '_').replace('/', '_').replace(':', '_')
-        logger.info(f"Normalized tool name: {tool_name} -> {normalized}")
+        # Tool names are a small fixed set, so each is normalized (and logged) only once
+        normalized = tool_name.translate(TOOL_NAME_TRANSLATION)
+        logger.debug("Normalized tool name: %s -> %s", tool_name, normalized)
         return normalized
     
     @staticmethod
     def get_tool_name4llm(server_id, tool_name, norm=True, ns_delimiter=delimiter):
         """Convert MCP server tool name to llm tool call"""
-        global tool_name_mapping, tool_name_mapping_r
         # prepend server prefix namespace to support multi-mcp-server
         tool_key = server_id + ns_delimiter + tool_name
         tool_name4llm = tool_key if not norm else MCPClient.normalize_tool_name(tool_key)
-        tool_name_mapping[tool_key] = tool_name4llm
-        tool_name_mapping_r[tool_name4llm] = tool_key
-        logger.info(f"Mapped MCP tool to LLM tool: {tool_key} -> {tool_name4llm}")
+        # Tool configs are rebuilt often; only log a mapping the first time it is seen
+        if registry.register(tool_key, tool_name4llm):
+            logger.debug("Mapped MCP tool to LLM tool: %s -> %s", tool_key, tool_name4llm)
         return tool_name4llm
     
     @staticmethod
     def get_tool_name4mcp(tool_name4llm, ns_delimiter=delimiter):
         """Convert llm tool call name to MCP server original name"""
-        global tool_name_mapping_r
-        server_id, tool_name = "", ""
-        tool_name4mcp = tool_name_mapping_r.get(tool_name4llm, "")
-        if len(tool_name4mcp.split(ns_delimiter)) == 2:
-            server_id, tool_name = tool_name4mcp.split(ns_delimiter)
-            logger.info(f"Converted LLM tool to MCP tool: {tool_name4llm} -> server: {server_id}, tool: {tool_name}")
+        cached = registry.split_cache.get((tool_name4llm, ns_delimiter))
+        if cached is not None:
+            return cached
+        tool_name4mcp = registry.lookup(tool_name4llm)
+        server_id, sep, tool_name = tool_name4mcp.partition(ns_delimiter)
+        if sep:
+            # Mappings are never overwritten, so a parsed name stays valid; misses are not cached
+            registry.split_cache[(tool_name4llm, ns_delimiter)] = server_id, tool_name
+            logger.debug("Converted LLM tool to MCP tool: %s -> server: %s, tool: %s", tool_name4llm, server_id, tool_name)
         else:
+            server_id, tool_name = "", ""
             logger.warning(f"Could not parse tool name: {tool_name4llm}, mapping: {tool_name4mcp}")
         return server_id, tool_name
 
@@ -83,128 +176,272 @@ class MCPClient:
         logger.info(f"Disconnecting to server [{self.name}]")
         await self.cleanup()
 
-    async def handle_resource_change(params: NotificationParams):
+    async def handle_resource_change(self, params: NotificationParams):
         logger.info(f"Resource change type: {params['changeType']}")
         logger.info(f"Affected URIs: {params['resourceURIs']}")
+        self._tool_config_cache.clear()
+        self._tools = None
+        self.clear_tool_cache()
+
+    async def handle_server_message(self, message):
+        """Drop cached tool configs when the server reports its tool list changed"""
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            logger.info(f"Server [{self.name}] tool list changed, invalidating tool config cache")
+            self._tool_config_cache.clear()
+            self._tools = None
+            self.clear_tool_cache()
+
+    def clear_tool_cache(self):
+        """Forget memoized tool results"""
+        self._result_cache.clear()
+        self._cache_generation += 1
     
-    
-    async def connect_to_server(self, server_script_path: str = "", server_script_args: list = [], 
-            server_script_envs: Dict = {}, command: str = "", server_url: str = ""):
+    async def connect_to_server(self, server_script_path: str = "", server_script_args: Optional[list] = None, 
+            server_script_envs: Optional[Dict] = None, command: str = "", server_url: str = ""):
         """Connect to an MCP server"""
         # if not ((command and server_script_args) or server_script_path):
         #     raise ValueError("Run server via script or command.")
         logger.info(f"Connecting to server [{self.name}]")
+        server_script_args = list(server_script_args) if server_script_args else []
+        server_script_envs = dict(server_script_envs) if server_script_envs else {}
+        connect_params = dict(server_script_path=server_script_path, server_script_args=server_script_args,
+            server_script_envs=server_script_envs, command=command, server_url=server_url)
         if  server_script_path:
             # run via script
-            is_python = server_script_path.endswith('.py')
-            is_js = server_script_path.endswith('.js')
-            is_uvx = server_script_path.startswith('uvx:')
-            is_np = server_script_path.startswith('npx:')
-            is_docker = server_script_path.startswith('docker:')
-            is_uv = server_script_path.startswith('uv:')
-
-            if not (is_python or is_js or is_uv or is_np or is_docker or is_uvx):
+            prefix, sep, rest = server_script_path.partition(':')
+            prefix_command = SCRIPT_PREFIX_COMMANDS.get(prefix) if sep else None
+            ext_command = SCRIPT_EXT_COMMANDS.get(os.path.splitext(server_script_path)[1])
+
+            if not (prefix_command or ext_command):
                 logger.error(f"Server script must be a .py or .js file or package: {server_script_path}")
                 raise ValueError("Server script must be a .py or .js file or package")
-            if is_uv or is_np or is_uvx:
-                server_script_path = server_script_path[server_script_path.index(':')+1:]
+            if prefix_command:
+                server_script_path = rest
 
             server_script_args = [server_script_path] + server_script_args
     
-            if is_python:
-                command = "python"
-            elif is_uv:
-                command = "uv"
-            elif is_uvx:
-                command = "uvx"
-            elif is_np:
-                command = "npx"
+            # a .py script always runs with python, otherwise the package prefix wins over .js
+            command = ext_command if ext_command == "python" else prefix_command or ext_command
+            if command == "npx":
                 server_script_args = ["-y"] + server_script_args
-            elif is_js:
-                command = "node"
-            elif is_docker:
-                command = "docker"
             
             logger.info(f"Using command: {command} with args: {server_script_args}")
 
-        env = get_default_environment()
-        if self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
-            env['AWS_ACCESS_KEY_ID'] =  self.env['AWS_ACCESS_KEY_ID']
-            env['AWS_SECRET_ACCESS_KEY'] = self.env['AWS_SECRET_ACCESS_KEY']
-            env['AWS_REGION'] = self.env['AWS_REGION']
-            logger.info(f"Using AWS credentials for region: {self.env['AWS_REGION']}")
-        env.update(server_script_envs)
+        env = {**self._base_env, **server_script_envs}
         try: 
             if server_url:
                 logger.info(f"Connecting to server URL: {server_url}")
-                transport = sse_client(server_url)
+                sse_kwargs = {'httpx_client_factory': sse_http_client} if SSE_ACCEPTS_CLIENT_FACTORY else {}
+                make_transport = lambda: sse_client(server_url, **sse_kwargs)
             else:
                 logger.info(f"Starting server process: {command} {' '.join(server_script_args)}")
-                transport = stdio_client(StdioServerParameters(
-                    command=command, args=server_script_args, env=env
-                ))
-        except Exception as e:
+                server_params = StdioServerParameters(command=command, args=server_script_args, env=env)
+                make_transport = lambda: stdio_client(server_params)
+        except (ValueError, TypeError) as e:
             logger.error(f"Failed to create transport: {e}")
             raise ValueError(f"Invalid server script or command. {e}")
         logger.info(f"Adding server {command} {server_script_args}")
+        ready = asyncio.get_running_loop().create_future()
+        self._session_stop = asyncio.Event()
+        self._session_task = asyncio.create_task(self._run_session(make_transport, ready, self._session_stop))
         try:
-            _stdio, _write = await self.exit_stack.enter_async_context(transport)
-            self.session = await self.exit_stack.enter_async_context(ClientSession(_stdio, _write))
-            await self.session.initialize()
-            logger.info(f"{self.name} session initialized successfully")
+            # shield: a cancelled caller must not cancel the readiness future, the task is cancelled below
+            await asyncio.shield(ready)
+        except asyncio.CancelledError:
+            self._session_task.cancel()
+            raise
         except Exception as e:
             logger.error(f"{self.name} session initialization failed: {e}")
             raise ValueError(f"Invalid server script or command. {e}")   
+        self._tool_config_cache.clear()
+        self._tools = None
+        self.clear_tool_cache()
+        logger.info(f"{self.name} session initialized successfully")
+        self._connect_params = connect_params
+        self._last_used = time.monotonic()
         await self.list_mcp_server()
+
+    async def _run_session(self, make_transport, ready: asyncio.Future, stop: asyncio.Event):
+        """Enter the transport and session contexts, keep them open until stop is set, then close them.
+
+        anyio only lets the task that entered a task group or cancel scope exit it, so one
+        long-lived task per connection owns them; callers in other tasks just signal stop.
+        """
+        exit_stack = self.exit_stack = AsyncExitStack()
+        session = None
+        try:
+            # A transport context can only be entered once, so every attempt starts a new one
+            for attempt in range(CONNECT_ATTEMPTS):
+                try:
+                    _stdio, _write = await exit_stack.enter_async_context(make_transport())
+                    break
+                # Only transient failures; a missing or non-executable command (FileNotFoundError,
+                # PermissionError) fails the same way on every attempt
+                except (ConnectionError, TimeoutError, httpx.TransportError) as e:
+                    if attempt == CONNECT_ATTEMPTS - 1:
+                        raise
+                    delay = min(CONNECT_MAX_DELAY, CONNECT_BASE_DELAY * (1 << attempt))
+                    logger.warning(f"{self.name} transport failed to start ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+            session = await exit_stack.enter_async_context(
+                ClientSession(_stdio, _write, message_handler=self.handle_server_message))
+            await session.initialize()
+            self.session = session
+            ready.set_result(None)
+            await stop.wait()
+        except asyncio.CancelledError:
+            ready.cancel()
+            raise
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.error(f"Server [{self.name}] session failed: {e}")
+        finally:
+            if session is not None and self.session is session:
+                self.session = None
+            try:
+                await exit_stack.aclose()
+                logger.info(f"Successfully closed exit stack for [{self.name}]")
+            except BaseException as e:
+                logger.error(f"Error during cleanup for [{self.name}]: {e}")
         
+    @classmethod
+    async def connect_many(cls, configs: list) -> list:
+        """Create and connect one client per config concurrently.
+
+        Each config holds the client ``name`` plus connect_to_server keyword arguments.
+        Every client's contexts live in its own session task, so the gather only waits
+        for each to become ready; the short-lived gather tasks own nothing.
+        Returns the clients in config order; a failed connection is returned as its exception.
+        """
+        clients = [cls(name=config['name']) for config in configs]
+        results = await asyncio.gather(*(
+            client.connect_to_server(**{k: v for k, v in config.items() if k != 'name'})
+            for client, config in zip(clients, configs)
+        ), return_exceptions=True)
+        # A connect can fail after its server started (e.g. listing tools), don't leave it running
+        await asyncio.gather(*(
+            client.cleanup() for client, result in zip(clients, results) if isinstance(result, BaseException)
+        ), return_exceptions=True)
+        return [result if isinstance(result, BaseException) else client for client, result in zip(clients, results)]
+
+    async def list_all_tools(self) -> list:
+        """List the server's tools, following pagination cursors when the SDK supports them"""
+        response = await self.session.list_tools()
+        if not response:
+            raise ValueError('list_tools returns empty')
+        tools = list(response.tools)
+        while LIST_TOOLS_ACCEPTS_CURSOR and response.nextCursor:
+            response = await self.session.list_tools(cursor=response.nextCursor)
+            tools.extend(response.tools)
+        return tools
+
     async def list_mcp_server(self):
-        try:
-            resource = await self.session.list_resources()
+        # resources and tools are independent requests, send them together
+        resource, tools = await asyncio.gather(
+            self.session.list_resources(), self.list_all_tools(), return_exceptions=True)
+        if isinstance(resource, McpError):
+            logger.info(f"Server [{self.name}] list_resources error: {str(resource)}")
+        elif isinstance(resource, BaseException):
+            raise resource
+        else:
             logger.info(f"Server [{self.name}] resources: {resource}")
-        except McpError as e:
-            logger.info(f"Server [{self.name}] list_resources error: {str(e)}")
         # List available tools
-        response = await self.session.list_tools()
-        tools = response.tools
+        if isinstance(tools, BaseException):
+            raise tools
+        self._tools = tools
         tool_names = [tool.name for tool in tools]
         logger.info(f"Connected to server [{self.name}] with tools: {tool_names}")
         
         
     async def get_tool_config(self, model_provider='bedrock', server_id : str = ''):
         """Get llm's tool usage config via MCP server"""
+        tool_config = self._tool_config_cache.get(server_id)
+        if tool_config is not None:
+            return tool_config
         # list tools via mcp server
         logger.info(f"Getting tool config for server [{self.name}] with ID [{server_id}]")
-        try:
-            response = await self.session.list_tools()
-            if not response:
-                logger.error('list_tools returns empty')
-                raise ValueError('list_tools returns empty')
-        except Exception as e:
-            logger.error(f'Failed to list tools: {e}')
-            return None
+        tools, self._tools = self._tools, None
+        if tools is None:
+            try:
+                tools = await self.list_all_tools()
+            except Exception as e:
+                logger.error(f'Failed to list tools: {e}')
+                return None
 
+        self._cacheable_tools = {
+            tool.name for tool in tools
+            if tool.name in CACHEABLE_TOOLS or (
+                getattr(getattr(tool, 'annotations', None), 'readOnlyHint', False)
+                and getattr(getattr(tool, 'annotations', None), 'idempotentHint', False))
+        }
         # for bedrock tool config
-        tool_config = {"tools": []}
-        for tool in response.tools:
-            tool_name_for_llm = MCPClient.get_tool_name4llm(server_id, tool.name, norm=True)
-            logger.info(f"Mapping tool: {tool.name} -> {tool_name_for_llm}")
-            tool_config["tools"].append({
-                "toolSpec":{
-                    "name": tool_name_for_llm,
-                    "description": tool.description, 
-                    "inputSchema": {"json": tool.inputSchema}
-                }
-            })
+        name4llm = MCPClient.get_tool_name4llm
+        tool_config = {"tools": [{
+            "toolSpec":{
+                "name": name4llm(server_id, tool.name, norm=True),
+                "description": tool.description, 
+                "inputSchema": {"json": tool.inputSchema}
+            }
+        } for tool in tools]}
 
         logger.info(f"Generated tool config with {len(tool_config['tools'])} tools")
+        self._tool_config_cache[server_id] = tool_config
         return tool_config
 
+    async def _ensure_session(self):
+        """Ping a session that has been idle longer than SESSION_TTL and reconnect it if it is dead"""
+        if self.session is not None and time.monotonic() - self._last_used < SESSION_TTL:
+            return
+        # The check runs in its own task, so a caller's timeout (e.g. the tool call's wait_for)
+        # cannot cancel a reconnect half way, and concurrent callers share one check
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._check_session())
+        await asyncio.shield(self._health_task)
+
+    async def _check_session(self):
+        if self.session is not None:
+            try:
+                await asyncio.wait_for(self.session.send_ping(), SESSION_PING_TIMEOUT)
+                self._last_used = time.monotonic()
+                return
+            except Exception as e:
+                logger.warning(f"Server [{self.name}] session health check failed: {e!r}")
+        if not self._connect_params:
+            raise ValueError(f"Server [{self.name}] is not connected")
+        logger.info(f"Reconnecting to server [{self.name}]")
+        # cleanup has the old session task close its own contexts, the new connection gets a new task
+        await self.cleanup()
+        await asyncio.wait_for(self.connect_to_server(**self._connect_params), SESSION_RECONNECT_TIMEOUT)
+
     async def call_tool(self, tool_name, tool_args):
         """Call tool via MCP server"""
-        logger.info(f"Calling tool [{tool_name}] with args: {tool_args}")
+        logger.debug("Calling tool [%s] with args: %s", tool_name, tool_args)
+        await self._ensure_session()
+        cache_key = None
+        if tool_name in self._cacheable_tools:
+            cache_key = (tool_name, json.dumps(tool_args, sort_keys=True, default=str))
+            cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                expires, result = cached
+                if time.monotonic() < expires:
+                    self._result_cache.move_to_end(cache_key)
+                    logger.debug("Tool [%s] result served from cache", tool_name)
+                    return result
+                del self._result_cache[cache_key]
+        else:
+            # Any other tool may change what the read-only ones return
+            self.clear_tool_cache()
+        generation = self._cache_generation
         try:
             result = await self.session.call_tool(tool_name, tool_args)
-            logger.info(f"Tool [{tool_name}] call successful")
+            self._last_used = time.monotonic()
+            logger.debug("Tool [%s] call successful", tool_name)
+            if cache_key is not None and not result.isError and generation == self._cache_generation:
+                self._result_cache[cache_key] = time.monotonic() + TOOL_RESULT_CACHE_TTL, result
+                if len(self._result_cache) > TOOL_RESULT_CACHE_SIZE:
+                    self._result_cache.popitem(last=False)
             return result
         except ValidationError as e:
             # Extract the actual tool result from the validation error
@@ -221,16 +458,19 @@ class MCPClient:
     async def cleanup(self):
         """Clean up resources"""
         logger.info(f"Cleaning up resources for server [{self.name}]")
+        self._tool_config_cache.clear()
+        self._tools = None
+        self.clear_tool_cache()
+        task, self._session_task = self._session_task, None
+        if task is None:
+            return
+        # The session task closes the contexts it entered; wait for it, whichever task cleanup runs in
+        self._session_stop.set()
         try:
-            await self.exit_stack.aclose()
-            logger.info(f"Successfully closed exit stack for [{self.name}]")
-        except RuntimeError as e:
-            # Handle the case where exit_stack is being closed in a different task
-            if "Attempted to exit cancel scope in a different task" in str(e):
-                # Create a new exit stack for future use
-                self.exit_stack = AsyncExitStack()
-                logger.warning(f"Handled cross-task exit_stack closure for [{self.name}]")
-            else:
-                # Re-raise if it's a different error
-                logger.error(f"Error during cleanup for [{self.name}]: {e}")
+            await asyncio.wait_for(asyncio.shield(task), SESSION_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Closing [{self.name}] took over {SESSION_CLOSE_TIMEOUT}s, cancelling its session task")
+            task.cancel()
+        except asyncio.CancelledError:
+            if not task.cancelled():
                 raise